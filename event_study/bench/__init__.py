@@ -0,0 +1,14 @@
+""" bench
+
+Benchmarks for the event_study pipeline on synthetic data.
+
+- `synth`: creates a synthetic universe of tickers (price, recommendation
+  and factor CSV files with the same schemas as the real ones)
+- `run`: times each stage of the pipeline for several universe sizes and
+  writes a JSON report, which can be compared across commits
+
+Usage (from the command line):
+
+    python -m event_study.bench --sizes 10 100 1000 --out bench.json
+    python -m event_study.bench --compare old.json new.json
+"""
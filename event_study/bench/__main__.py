@@ -0,0 +1,37 @@
+""" __main__.py
+
+Command line interface for the benchmarks (see `event_study.bench`)
+"""
+import argparse
+
+from event_study.bench import run
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        prog='python -m event_study.bench',
+        description='Benchmarks the event_study pipeline on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help='number of tickers of each universe')
+    parser.add_argument('--events', type=int, default=50,
+                        help='upgrades and downgrades per ticker')
+    parser.add_argument('--days', type=int, default=2520,
+                        help='trading days with prices per ticker')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--n-main', type=int, default=10,
+                        help='tickers for which main.main is timed')
+    parser.add_argument('--out', help='location of the JSON report')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two reports instead of running')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    if args.compare is not None:
+        print(run.compare(*args.compare))
+    else:
+        run.run_bench(sizes=args.sizes, events_per_tic=args.events,
+                      n_days=args.days, seed=args.seed, repeat=args.repeat,
+                      n_main=args.n_main, out=args.out)
@@ -0,0 +1,183 @@
+""" run.py
+
+Utilities to time the event_study pipeline on synthetic universes (see
+`synth`) and to compare the reports of different commits.
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from event_study import main
+from event_study import mk_cars
+from event_study import mk_events
+from event_study import mk_rets
+from event_study import test_hypo
+from event_study.bench import synth
+
+# Version of the report format
+REPORT_VERSION = 1
+
+
+def run_bench(sizes=(10, 100, 1000), events_per_tic=50, n_days=2520, seed=0,
+              repeat=3, n_main=10, out=None):
+    """ Times each stage of the pipeline for synthetic universes of several
+    sizes.
+
+    Parameters
+    ----------
+    sizes : tuple of int, optional
+        Number of tickers of each universe. Defaults to (10, 100, 1000).
+
+    events_per_tic, n_days, seed : optional
+        See `synth.mk_universe`
+
+    repeat : int, optional
+        Number of times each stage is run. Defaults to 3.
+
+    n_main : int, optional
+        Number of tickers for which `main.main` is timed (it processes a
+        single ticker). Defaults to 10.
+
+    out : str, optional
+        If given, the report is saved as JSON in this file
+
+    Returns
+    -------
+    dict
+        The report, with the keys:
+            'meta' : dict with the parameters and the environment (commit,
+                versions of Python, numpy and pandas)
+            'results' : list with one dict per (size, stage), with the keys
+                'n_tics', 'stage', 'rows', 'first_s' (wall time of the first
+                run, which reads the CSV files), 'best_s' (best wall time)
+                and 'cpu_s' (CPU time of the best run)
+
+    Notes
+    -----
+    The stages are:
+        mk_rets : mk_rets.mk_panel_ret_df
+        mk_events : mk_events.mk_panel_event_df
+        mk_cars : mk_cars.mk_cars_df
+        test_hypo : test_hypo.calc_tstats (pooled and by ticker)
+        main : main.main for `n_main` tickers, without downloads
+
+    Output printed by the pipeline is discarded.
+    """
+    report = {
+        'meta': {
+            'version': REPORT_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'params': {'sizes': list(sizes), 'events_per_tic': events_per_tic,
+                       'n_days': n_days, 'seed': seed, 'repeat': repeat,
+                       'n_main': n_main},
+        },
+        'results': [],
+    }
+    for n_tics in sizes:
+        with tempfile.TemporaryDirectory() as datadir:
+            t0 = time.perf_counter()
+            tics = synth.mk_universe(datadir, n_tics,
+                                     events_per_tic=events_per_tic,
+                                     n_days=n_days, seed=seed)
+            print(f'{n_tics} tickers: data created in '
+                  f'{time.perf_counter() - t0:.1f}s')
+            with synth.use_datadir(datadir):
+                res = _run_stages(tics, repeat=repeat, n_main=n_main)
+        for rec in res:
+            rec['n_tics'] = n_tics
+            print(f"  {rec['stage']:<10} {rec['best_s']:.4f}s "
+                  f"({rec['rows']} rows)")
+        report['results'].extend(res)
+
+    if out is not None:
+        with open(out, 'w') as fobj:
+            json.dump(report, fobj, indent=2)
+    return report
+
+
+def _run_stages(tics, repeat, n_main):
+    """ Times each stage for the tickers `tics` (see `run_bench`)
+    """
+    out = {}
+
+    def _time(name, func):
+        # Runs `func` `repeat` times, keeping the last output
+        walls, cpus = [], []
+        for _ in range(repeat):
+            wall0, cpu0 = time.perf_counter(), time.process_time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                out[name] = func()
+            walls.append(time.perf_counter() - wall0)
+            cpus.append(time.process_time() - cpu0)
+        best = int(np.argmin(walls))
+        return {'stage': name, 'first_s': walls[0], 'best_s': walls[best],
+                'cpu_s': cpus[best]}
+
+    res = []
+    res.append(_time('mk_rets', lambda: mk_rets.mk_panel_ret_df(tics)))
+    res[-1]['rows'] = len(out['mk_rets'])
+    res.append(_time('mk_events', lambda: mk_events.mk_panel_event_df(tics)))
+    res[-1]['rows'] = len(out['mk_events'])
+    res.append(_time('mk_cars', lambda: mk_cars.mk_cars_df(
+        out['mk_rets'], out['mk_events'].copy())))
+    res[-1]['rows'] = len(out['mk_cars'])
+    res.append(_time('test_hypo', lambda: (
+        test_hypo.calc_tstats(out['mk_cars']),
+        test_hypo.calc_tstats(out['mk_cars'], by='tic'))))
+    res[-1]['rows'] = len(out['mk_cars'])
+    main_tics = tics[:n_main]
+    res.append(_time('main', lambda: [main.main(tic, update_csv=False)
+                                      for tic in main_tics]))
+    res[-1]['rows'] = len(main_tics)
+    return res
+
+
+def compare(old, new):
+    """ Compares two reports created by `run_bench`.
+
+    Parameters
+    ----------
+    old, new : str or dict
+        Reports (or the location of the JSON files)
+
+    Returns
+    -------
+    dataframe
+        A data frame indexed by (n_tics, stage) with the best wall times of
+        each report ('old_s' and 'new_s') and the speedup (old_s / new_s)
+    """
+    def _load(report):
+        if isinstance(report, str):
+            with open(report) as fobj:
+                report = json.load(fobj)
+        df = pd.DataFrame(report['results'])
+        return df.set_index(['n_tics', 'stage']).loc[:, 'best_s']
+
+    df = pd.DataFrame({'old_s': _load(old), 'new_s': _load(new)})
+    df.loc[:, 'speedup'] = df.loc[:, 'old_s'] / df.loc[:, 'new_s']
+    return df
+
+
+def _git_commit():
+    """ Returns the current git commit of the repository, or None
+    """
+    try:
+        res = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return res.stdout.strip()
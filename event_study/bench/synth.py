@@ -0,0 +1,149 @@
+""" synth.py
+
+Utilities to create a synthetic universe of tickers for the benchmarks.
+
+The files have the same schemas as the real ones:
+    <tic>_prc.csv : Date,Open,High,Low,Close,Adj Close,Volume
+    <tic>_rec.csv : Date,Firm,To Grade,From Grade,Action
+    ff_daily.csv : Date,mkt-rf,smb,hml,rf,mkt
+
+The data for each ticker is drawn from its own random generator, seeded with
+(`seed`, position of the ticker). The files for a given ticker are the same
+regardless of the number of tickers in the universe.
+"""
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import event_study.config as cfg
+from event_study import factors
+
+# Synthetic brokers and grades
+FIRMS = [f'Broker {i:02d}' for i in range(30)]
+GRADES = ['Buy', 'Outperform', 'Hold', 'Underperform', 'Sell']
+# Actions which are not upgrades or downgrades
+OTHER_ACTIONS = ['main', 'init', 'reit']
+
+
+def tickers(n_tics):
+    """ Returns the names of the first `n_tics` synthetic tickers
+    """
+    return [f'S{i:05d}' for i in range(n_tics)]
+
+
+def mk_universe(datadir, n_tics, events_per_tic=50, n_days=2520, seed=0):
+    """ Creates the CSV files of a synthetic universe in `datadir`.
+
+    Parameters
+    ----------
+    datadir : str
+        Output folder (must exist)
+
+    n_tics : int
+        Number of tickers
+
+    events_per_tic : int, optional
+        Number of upgrades and downgrades per ticker. Each ticker also gets
+        half as many other recommendations (see `OTHER_ACTIONS`), which
+        are not events. Defaults to 50.
+
+    n_days : int, optional
+        Number of trading days with prices. The factors file has one more
+        year of data. Defaults to 2520 (about 10 years).
+
+    seed : int, optional
+        Seed of the random generators. Defaults to 0.
+
+    Returns
+    -------
+    list of str
+        Tickers
+    """
+    # Calendar: business days ending on `cfg.END`
+    ff_df = mk_ff_df(n_days + 252, seed=seed)
+    ff_df.to_csv(os.path.join(datadir, 'ff_daily.csv'))
+
+    tics = tickers(n_tics)
+    with use_datadir(datadir):
+        for i, tic in enumerate(tics):
+            rng = np.random.default_rng([seed, i + 1])
+            locs = cfg.csv_locs(tic)
+            mk_prc_df(ff_df.iloc[-n_days:], rng).to_csv(locs['prc_csv'])
+            mk_rec_df(ff_df.index[-n_days:], events_per_tic, rng).to_csv(
+                locs['rec_csv'])
+    return tics
+
+
+def mk_ff_df(n_days, seed=0):
+    """ Returns `n_days` of synthetic daily Fama-French factors, ending on
+    `cfg.END`
+    """
+    rng = np.random.default_rng([seed, 0])
+    idx = pd.bdate_range(end=cfg.END, periods=n_days, name='Date')
+    df = pd.DataFrame({
+        'mkt-rf': rng.normal(0.0004, 0.01, n_days),
+        'smb': rng.normal(0.0, 0.005, n_days),
+        'hml': rng.normal(0.0, 0.005, n_days),
+        'rf': np.full(n_days, 0.0001),
+    }, index=idx)
+    df.loc[:, 'mkt'] = df.loc[:, 'mkt-rf'] + df.loc[:, 'rf']
+    return df
+
+
+def mk_prc_df(ff_df, rng):
+    """ Returns synthetic daily prices following a one-factor model on the
+    market returns in `ff_df`
+    """
+    n = len(ff_df)
+    beta = rng.uniform(0.5, 1.5)
+    ret = beta * ff_df.loc[:, 'mkt'].to_numpy() + rng.normal(0.0, 0.02, n)
+    close = 100 * np.cumprod(1 + ret)
+    open_ = close * (1 + rng.normal(0.0, 0.005, n))
+    return pd.DataFrame({
+        'Open': open_,
+        'High': np.maximum(open_, close) * (1 + rng.uniform(0, 0.01, n)),
+        'Low': np.minimum(open_, close) * (1 - rng.uniform(0, 0.01, n)),
+        'Close': close,
+        'Adj Close': close,
+        'Volume': rng.integers(100_000, 10_000_000, n),
+    }, index=ff_df.index)
+
+
+def mk_rec_df(days, events_per_tic, rng):
+    """ Returns synthetic recommendations on random dates in `days`, with
+    `events_per_tic` upgrades and downgrades
+    """
+    n_other = events_per_tic // 2
+    n = events_per_tic + n_other
+    actions = np.concatenate([rng.choice(['up', 'down'], events_per_tic),
+                              rng.choice(OTHER_ACTIONS, n_other)])
+    # Random times between 06:00 and 20:00
+    dates = (days.to_numpy()[rng.integers(0, len(days), n)]
+             + pd.to_timedelta(rng.integers(6 * 3600, 20 * 3600, n), unit='s'))
+    df = pd.DataFrame({
+        'Firm': rng.choice(FIRMS, n),
+        'To Grade': rng.choice(GRADES, n),
+        'From Grade': rng.choice(GRADES, n),
+        'Action': actions,
+    }, index=pd.DatetimeIndex(dates, name='Date'))
+    return df.sort_index()
+
+
+@contextmanager
+def use_datadir(datadir):
+    """ Context manager pointing `cfg.DATADIR` and `cfg.FF_FACTORS_CSV` to the
+    synthetic universe in `datadir`. The original values are restored on
+    exit.
+    """
+    old = (cfg.DATADIR, cfg.FF_FACTORS_CSV)
+    cfg.DATADIR = datadir
+    cfg.FF_FACTORS_CSV = os.path.join(datadir, 'ff_daily.csv')
+    factors.clear_cache()
+    try:
+        yield
+    finally:
+        cfg.DATADIR, cfg.FF_FACTORS_CSV = old
+        factors.clear_cache()
+
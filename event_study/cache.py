@@ -0,0 +1,128 @@
+""" cache.py
+
+Binary (Parquet) cache for the parsed source CSV files.
+
+The first time a CSV file is read with `read_cached`, the parsed data frame is
+saved in a "sidecar" file next to the CSV file (<csv file>.parquet). Later
+reads use the sidecar file if the size and modification time of the CSV file
+have not changed and, for source files read with `cfg.read_csv`, if the
+schema (`cfg.SCHEMAS`) and parser (`cfg.CSV_ENGINE`) are the same.
+
+Notes
+-----
+- Requires the `pyarrow` package. If it is not installed (or if
+  `cfg.CSV_CACHE` is False), the CSV file is always parsed.
+"""
+import json
+import os
+
+import event_study.config as cfg
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ModuleNotFoundError:
+    pa = None
+    pq = None
+
+# Increase this number when the format of the cached data changes, so that
+# existing sidecar files are ignored (changes to `cfg.SCHEMAS` and
+# `cfg.CSV_ENGINE` are detected automatically, see `_src_info`)
+_CACHE_VERSION = 3
+
+# Key used to store information about the source CSV in the Parquet metadata
+_META_KEY = b'event_study_src'
+
+
+def read_cached(pth, reader, kind=None):
+    """ Returns the data frame `reader(pth)`, using the sidecar file for
+    `pth` if it is up to date.
+
+    Parameters
+    ----------
+    pth : str
+        Location of the CSV file
+
+    reader : function
+        Function that parses the CSV file `pth` and returns a data frame
+
+    kind : str, optional
+        Type of file in `cfg.SCHEMAS` ('prc', 'rec' or 'ff') used by
+        `reader`. If given, the sidecar file is only used if it was created
+        with the same schema and `cfg.CSV_ENGINE`.
+
+    Returns
+    -------
+    dataframe
+        The output of `reader(pth)`
+
+    """
+    if cfg.CSV_CACHE is not True or pq is None:
+        return reader(pth)
+
+    src = _src_info(pth, reader, kind)
+    sidecar = sidecar_path(pth)
+    df = _read_sidecar(sidecar, src)
+    if df is None:
+        df = reader(pth)
+        _write_sidecar(df, sidecar, src)
+    return df
+
+
+def sidecar_path(pth):
+    """ Returns the location of the sidecar file for the CSV file `pth`
+    """
+    return f'{pth}.parquet'
+
+
+def _src_info(pth, reader, kind=None):
+    """ Returns a dictionary identifying the current version of the CSV file
+    `pth` and the reader (and, if `kind` is given, the schema and parser) used
+    to parse it
+    """
+    stat = os.stat(pth)
+    src = {
+        'version': _CACHE_VERSION,
+        'reader': f'{reader.__module__}.{reader.__qualname__}',
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+    if kind is not None:
+        src['schema'] = json.dumps(cfg.SCHEMAS[kind], sort_keys=True,
+                                   default=str)
+        src['engine'] = cfg.CSV_ENGINE
+    return src
+
+
+def _read_sidecar(sidecar, src):
+    """ Returns the data frame in `sidecar` or None if the sidecar file does
+    not exist or is out of date
+    """
+    if not os.path.exists(sidecar):
+        return None
+    try:
+        meta = pq.read_schema(sidecar).metadata or {}
+        if json.loads(meta.get(_META_KEY, b'{}')) != src:
+            return None
+        return pq.read_table(sidecar).to_pandas()
+    except (OSError, ValueError, pa.ArrowException):
+        # Unreadable sidecar files are ignored (and replaced)
+        return None
+
+
+def _write_sidecar(df, sidecar, src):
+    """ Saves `df` in the `sidecar` file. The file is written to a temporary
+    location first, so other processes never see a partially written file.
+    """
+    table = pa.Table.from_pandas(df)
+    meta = dict(table.schema.metadata or {})
+    meta[_META_KEY] = json.dumps(src).encode()
+    table = table.replace_schema_metadata(meta)
+    tmp = f'{sidecar}.{os.getpid()}.tmp'
+    try:
+        pq.write_table(table, tmp)
+        os.replace(tmp, sidecar)
+    except OSError:
+        # E.g. read-only data folder: simply do not cache
+        if os.path.exists(tmp):
+            os.remove(tmp)
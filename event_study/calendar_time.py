@@ -0,0 +1,196 @@
+""" calendar_time.py
+
+Utilities to build calendar-time portfolios, an alternative to event-time
+CARs when event windows overlap.
+
+Each trading day, the portfolio holds (equally weighted) the stocks with an
+event of a given type in the last `holding` trading days. The alpha of the
+portfolio with respect to the Fama-French factors measures the average
+abnormal return.
+"""
+import numpy as np
+import pandas as pd
+
+from event_study import factors
+from event_study import mk_cars
+
+
+# --------------------------------------------------------
+#   Function to build the portfolio
+# --------------------------------------------------------
+def mk_calendar_df(ret_df, event_df, event_type='upgrade', holding=20,
+                   ff_df=None):
+    """ Creates the daily returns of a calendar-time portfolio.
+
+    Parameters
+    ----------
+    ret_df : dataframe
+        Data frame with the stock returns (column 'ret'), created by
+        `mk_rets.mk_ret_df` (single ticker) or `mk_rets.mk_panel_ret_df`
+        (panel)
+
+    event_df : dataframe
+        Data frame with the events, created by `mk_events.mk_event_df` or
+        `mk_events.mk_panel_event_df`
+
+    event_type : str, optional
+        Type of event ('upgrade' or 'downgrade'). Defaults to 'upgrade'.
+
+    holding : int, optional
+        Number of trading days a stock stays in the portfolio after an event,
+        including the event date. Defaults to 20.
+
+    ff_df : dataframe, optional
+        Fama-French factors. The trading days in this data frame define the
+        calendar. If None (the default), `factors.get_ff_df()`
+
+    Returns
+    -------
+    dataframe
+        A data frame indexed by the trading days in `ff_df`, with the
+        factors and the columns:
+            port_ret : float
+                Equal-weighted return of the portfolio (np.nan if empty)
+            n_stocks : int
+                Number of stocks in the portfolio
+
+    Notes
+    -----
+    Events on non-trading days enter the portfolio on the next trading day.
+    A stock enters the portfolio only once, even if it has several events
+    in the last `holding` days.
+
+    Membership is computed without looping over days: events are sorted by
+    (stock, trading day) and, for every stock return, the last event on or
+    before that day is found with `np.searchsorted`. The return belongs to
+    the portfolio if this event is less than `holding` days old.
+    """
+    if ff_df is None:
+        ff_df = factors.get_ff_df()
+    days = _days(ff_df.index)
+
+    # --------------------------------------------------------
+    #   Step 1: Integer codes for stocks and trading days
+    # --------------------------------------------------------
+    events = event_df.loc[event_df.loc[:, 'event_type'] == event_type]
+    if mk_cars._is_panel(ret_df):
+        # Use the codes of the index levels (no need to factorize)
+        tics = ret_df.index.levels[0]
+        ret_codes = ret_df.index.codes[0]
+        if 'tic' in events.index.names:
+            event_tics = events.index.get_level_values('tic')
+        else:
+            event_tics = events.loc[:, 'tic']
+        event_codes = tics.get_indexer(event_tics)
+        ret_pos = _calendar_pos(days, ret_df.index.levels[-1])
+        ret_pos = np.where(ret_df.index.codes[-1] >= 0,
+                           ret_pos[ret_df.index.codes[-1]], -1)
+    else:
+        ret_codes = np.zeros(len(ret_df), dtype=np.int64)
+        event_codes = np.zeros(len(events), dtype=np.int64)
+        ret_pos = _calendar_pos(days, ret_df.index)
+
+    # Position of the first trading day on or after each event
+    event_pos = np.searchsorted(days, _days(events.loc[:, 'event_date']))
+
+    # --------------------------------------------------------
+    #   Step 2: Membership of each stock return
+    # --------------------------------------------------------
+    stride = len(days) + 1
+    ok = (event_codes >= 0) & (event_pos < len(days))
+    event_keys = np.sort(event_codes[ok].astype(np.int64) * stride
+                         + event_pos[ok])
+    ret_keys = ret_codes.astype(np.int64) * stride + ret_pos
+    # Last event of the same stock on or before the day of each return
+    last = np.searchsorted(event_keys, ret_keys, side='right') - 1
+    last_key = event_keys[np.maximum(last, 0)]
+    ret = ret_df.loc[:, 'ret'].to_numpy(dtype=float)
+    member = ((ret_pos >= 0) & (last >= 0)
+              & (last_key // stride == ret_codes)
+              & (ret_pos - last_key % stride < holding)
+              & ~np.isnan(ret))
+
+    # --------------------------------------------------------
+    #   Step 3: Equal-weighted portfolio return
+    # --------------------------------------------------------
+    n_stocks = np.bincount(ret_pos[member], minlength=len(days))
+    ret_sum = np.bincount(ret_pos[member], weights=ret[member],
+                          minlength=len(days))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        port_ret = np.where(n_stocks > 0, ret_sum / n_stocks, np.nan)
+
+    df = ff_df.copy()
+    df.loc[:, 'port_ret'] = port_ret
+    df.loc[:, 'n_stocks'] = n_stocks
+    return df
+
+
+# --------------------------------------------------------
+#   Function to estimate the alpha of the portfolio
+# --------------------------------------------------------
+def calc_calendar_alpha(cal_df, factor_cols=('mkt-rf', 'smb', 'hml')):
+    """ Regresses the excess return of a calendar-time portfolio on the
+    Fama-French factors.
+
+    Parameters
+    ----------
+    cal_df : dataframe
+        Data frame created by `mk_calendar_df`
+
+    factor_cols : tuple, optional
+        Factors used as regressors. Defaults to ('mkt-rf', 'smb', 'hml').
+
+    Returns
+    -------
+    dataframe
+        A data frame with one row per coefficient ('alpha' followed by
+        `factor_cols`) and the columns 'coef', 'se' and 't'. The attribute
+        `attrs['n_obs']` is the number of days used (days with an empty
+        portfolio are dropped).
+    """
+    cols = list(factor_cols)
+    df = cal_df.loc[cal_df.loc[:, 'n_stocks'] > 0, ['port_ret', 'rf'] + cols]
+    df = df.dropna()
+    y = (df.loc[:, 'port_ret'] - df.loc[:, 'rf']).to_numpy()
+    X = np.column_stack([np.ones(len(df)), df.loc[:, cols].to_numpy()])
+
+    coef, _, rank, _ = np.linalg.lstsq(X, y, rcond=None)
+    resid = y - X @ coef
+    dof = len(y) - rank
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sigma2 = resid @ resid / dof
+        se = np.sqrt(sigma2 * np.diag(np.linalg.pinv(X.T @ X)))
+        t = coef / se
+
+    res = pd.DataFrame({'coef': coef, 'se': se, 't': t},
+                       index=['alpha'] + cols)
+    res.attrs['n_obs'] = len(y)
+    return res
+
+
+def _calendar_pos(days, dates):
+    """ Returns the position of each date in the sorted array `days` (see
+    `_days`), or -1 if the date is not in `days`
+    """
+    dates = _days(dates)
+    pos = np.searchsorted(days, dates)
+    pos[pos == len(days)] = 0
+    return np.where(days[pos] == dates, pos, -1)
+
+
+def _days(dates):
+    """ Converts dates into the number of days since 1970-01-01
+    """
+    dates = pd.DatetimeIndex(pd.to_datetime(dates))
+    return dates.to_numpy().astype('datetime64[D]').astype(np.int64)
+
+
+if __name__ == "__main__":
+    from event_study import mk_rets, mk_events
+    tic = 'TSLA'
+    ret_df = mk_rets.mk_ret_df(tic)
+    event_df = mk_events.mk_event_df(tic)
+    for event_type in ['upgrade', 'downgrade']:
+        cal_df = mk_calendar_df(ret_df, event_df, event_type=event_type)
+        print(event_type)
+        print(calc_calendar_alpha(cal_df))
@@ -2,8 +2,12 @@
 
 Configuration file for the event_study package
 """
+import csv
+import importlib.util
 import os
 
+import pandas as pd
+
 import toolkit_config as tk_cfg
 
 # --------------------------------------------------------
@@ -11,8 +15,56 @@ import toolkit_config as tk_cfg
 # --------------------------------------------------------
 DATADIR = tk_cfg.DATADIR
 FF_FACTORS_CSV = os.path.join(DATADIR, 'ff_daily.csv')
+# Persisted CARs (see `event_study.store`)
+CARS_STORE_CSV = os.path.join(DATADIR, 'cars_store.csv')
 START = '1900-01-01'
 END = '2020-12-31'
+# If True, parsed CSV files are cached in binary sidecar files (see
+# `event_study.cache`)
+CSV_CACHE = True
+# If True, `main.main` records the time and memory used by each stage (see
+# `event_study.instrument`). Set the environment variable
+# EVENT_STUDY_PROFILE=1 to turn it on. The JSON records are appended to
+# EVENT_STUDY_PROFILE_LOG if set, or printed to standard error.
+PROFILE = os.environ.get('EVENT_STUDY_PROFILE', '0').lower() not in ('', '0', 'false')
+PROFILE_LOG = os.environ.get('EVENT_STUDY_PROFILE_LOG') or None
+# Regular trading session of the exchange (local time), used to time
+# intraday events (see `mk_events.shift_event_dates`)
+SESSION = {'open': '09:30:00', 'close': '16:00:00'}
+# Parser used by `read_csv`: 'c' or 'pyarrow'. Note that 'pyarrow' may parse
+# some floats differently from 'c' (last digit)
+CSV_ENGINE = 'c'
+
+
+# --------------------------------------------------------
+#   Schemas of the source CSV files
+# --------------------------------------------------------
+# For each type of file:
+#   'date_col': name of the date column in the file (used as the index)
+#   'date_format': format of the dates (see `pd.to_datetime`)
+#   'dtypes': dictionary mapping the (standardised) names of the columns to
+#             read to their dtypes. Other columns are not read.
+SCHEMAS = {
+    # <prc csv>: Date,Open,High,Low,Close,Adj Close,Volume
+    'prc': {
+        'date_col': 'Date',
+        'date_format': '%Y-%m-%d',
+        'dtypes': {'close': 'float64', 'volume': 'float64'},
+    },
+    # <rec csv>: Date,Firm,To Grade,From Grade,Action
+    'rec': {
+        'date_col': 'Date',
+        'date_format': '%Y-%m-%d %H:%M:%S',
+        'dtypes': {'firm': 'str', 'action': 'str'},
+    },
+    # Fama-French factors: Date,mkt-rf,smb,hml,rf,mkt
+    'ff': {
+        'date_col': 'Date',
+        'date_format': '%Y-%m-%d',
+        'dtypes': {'mkt-rf': 'float64', 'smb': 'float64', 'hml': 'float64',
+                   'rf': 'float64', 'mkt': 'float64'},
+    },
+}
 
 
 # --------------------------------------------------------
@@ -44,23 +96,74 @@ def csv_locs(tic):
 
 
 # --------------------------------------------------------
-#   Aux function to process col names
+#   Typed CSV loader
 # --------------------------------------------------------
-def standardise_colnames(df):
-    """ Renames the columns in `df` so that
-    - Names are lower case
-    - Spaces are replaced with '_'
+def read_csv(pth, kind, engine=None):
+    """ Reads the source CSV file `pth` using the schema `SCHEMAS[kind]`.
 
     Parameters
     ----------
-    df : dataframe
+    pth : str
+        Location of the CSV file
+
+    kind : str
+        Type of file ('prc', 'rec' or 'ff')
+
+    engine : str, optional
+        Parser ('c' or 'pyarrow'). If None (the default), `CSV_ENGINE`. If
+        'pyarrow' is not installed, 'c' is used.
+
+    Returns
+    -------
+    dataframe
+        A data frame indexed by date (DatetimeIndex named after the date
+        column), with the columns in the schema (standardised names, see
+        `standardise_colnames`) in the order of the file.
 
     Notes
     -----
-    - If column with the standardised name already exists, the new column will
-      include a '_' prefix
+    Only the header is standardised: the names are used to select the
+    columns to read (`usecols`) and to rename them. Columns in the schema
+    which are not in the file are ignored.
+    """
+    schema = SCHEMAS[kind]
+    date_col = schema['date_col']
+    with open(pth, newline='', encoding='utf-8-sig') as fobj:
+        header = next(csv.reader(fobj), [])
+    names = dict(zip(header, standardise_names(header)))
+    usecols = [c for c in header
+               if c == date_col or names[c] in schema['dtypes']]
+    if date_col not in usecols:
+        raise ValueError(f'Column {date_col} not found in {pth}')
+    dtypes = {c: schema['dtypes'][names[c]] for c in usecols if c != date_col}
+
+    df = pd.read_csv(pth, usecols=usecols, dtype=dtypes,
+                     parse_dates=[date_col],
+                     date_format=schema['date_format'],
+                     engine=_csv_engine(engine))
+    df = df.set_index(date_col)
+    df.columns = [names[c] for c in df.columns]
+    return df
+
+
+def _csv_engine(engine):
+    """ Returns the pandas parser for `engine` (see `read_csv`)
     """
-    cols = set(df.columns)
+    if engine is None:
+        engine = CSV_ENGINE
+    if engine == 'pyarrow' and importlib.util.find_spec('pyarrow') is None:
+        engine = 'c'
+    return engine
+
+
+# --------------------------------------------------------
+#   Aux function to process col names
+# --------------------------------------------------------
+def standardise_names(names):
+    """ Returns the standardised version of the column names in `names` (see
+    `standardise_colnames`)
+    """
+    cols = set(names)
 
     # You can define `local` functions
     def _parse_name(colname):
@@ -80,4 +183,22 @@ def standardise_colnames(df):
         else:
             return new_name
 
-    return df.rename(columns=_parse_name)
\ No newline at end of file
+    return [_parse_name(c) for c in names]
+
+
+def standardise_colnames(df):
+    """ Renames the columns in `df` so that
+    - Names are lower case
+    - Spaces are replaced with '_'
+
+    Parameters
+    ----------
+    df : dataframe
+
+    Notes
+    -----
+    - If column with the standardised name already exists, the new column will
+      include a '_' prefix
+    """
+    return df.rename(columns=dict(zip(df.columns,
+                                      standardise_names(df.columns))))
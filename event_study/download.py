@@ -2,27 +2,51 @@
 
 Utilities to download data from Yahoo Finance
 """
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
 import yfinance as yf
 
 from event_study import config as cfg
 
 
 # --------------------------------------------------------
-#   Function to download recommendations
+#   Functions to fetch the data from Yahoo Finance
 # --------------------------------------------------------
-def yf_rec_to_csv(tic, pth,
-                  start=None,
-                  end=None):
-    """ Downloads analysts recommendation from Yahoo Finance and saves the
-    information in a CSV file
+def yf_fetch_prc(tic, start=None, end=None):
+    """ Downloads daily prices from Yahoo Finance and returns them as a data
+    frame indexed by date
 
     Parameters
     ----------
     tic : str
         Ticker
 
-    pth : str
-        Location of the output CSV file
+    start: str, optional
+        Download start date string (YYYY-MM-DD)
+
+    end: str, optional
+        Download end date string (YYYY-MM-DD)
+    """
+    return yf.download(tic,
+            start=start,
+            end=end,
+            ignore_tz=True
+            )
+
+
+def yf_fetch_rec(tic, start=None, end=None):
+    """ Downloads analysts recommendation from Yahoo Finance and returns them
+    as a data frame indexed by date
+
+    Parameters
+    ----------
+    tic : str
+        Ticker
 
     start: str, optional
         Download start date string (YYYY-MM-DD)
@@ -33,7 +57,6 @@ def yf_rec_to_csv(tic, pth,
         If None (the default), end is set to the most current date available
     """
     c = yf.Ticker(tic)
-    c.history(start=start, end=end).tz_localize(None)
     # Make sure we only relevant dates
     if start is not None and end is not None:
         df = c.recommendations.loc[start:end]
@@ -43,10 +66,39 @@ def yf_rec_to_csv(tic, pth,
         df = c.recommendations.loc[:end]
     else:
         df = c.recommendations
-    df.to_csv(pth)
+    return df
 
 
-def get_data(tic):
+# --------------------------------------------------------
+#   Function to download recommendations
+# --------------------------------------------------------
+def yf_rec_to_csv(tic, pth,
+                  start=None,
+                  end=None):
+    """ Downloads analysts recommendation from Yahoo Finance and saves the
+    information in a CSV file
+
+    Parameters
+    ----------
+    tic : str
+        Ticker
+
+    pth : str
+        Location of the output CSV file
+
+    start: str, optional
+        Download start date string (YYYY-MM-DD)
+        If None (the default), start is set to '1900-01-01'
+
+    end: str, optional
+        Download end date string (YYYY-MM-DD)
+        If None (the default), end is set to the most current date available
+    """
+    df = yf_fetch_rec(tic, start=start, end=end)
+    to_csv_atomic(df, pth)
+
+
+def get_data(tic, fetch_prc=None, fetch_rec=None, incremental=False):
     """ Downloads price and recommendation data for a given ticker `tic`
     given the sample period defined by the `config` variables `START` and
     `END`.
@@ -56,29 +108,250 @@ def get_data(tic):
     tic : str
         Ticker
 
+    fetch_prc : function, optional
+        Function with signature `fetch_prc(tic, start, end)` returning a data
+        frame with prices. If None (the default), `yf_fetch_prc`
+
+    fetch_rec : function, optional
+        Function with signature `fetch_rec(tic, start, end)` returning a data
+        frame with recommendations. If None (the default), `yf_fetch_rec`
+
+    incremental : bool, optional
+        If True, only download the prices which are not yet in the price CSV
+        file (see `update_prc_csv`). Defaults to False.
+
     """
+    if fetch_prc is None:
+        fetch_prc = yf_fetch_prc
+    if fetch_rec is None:
+        fetch_rec = yf_fetch_rec
+
     # Get output paths
     locs = cfg.csv_locs(tic)
 
     # Download and save prices
     print(f'Downloading prices for {tic}...')
-    df = yf.download(tic,
-            start=cfg.START,
-            end=cfg.END,
-            ignore_tz=True
-            )
-    pth = locs['prc_csv']
-    df.to_csv(pth)
+    if incremental is True:
+        update_prc_csv(tic, fetch_prc=fetch_prc)
+    else:
+        df = fetch_prc(tic, start=cfg.START, end=cfg.END)
+        to_csv_atomic(df, locs['prc_csv'])
     print('Done')
 
     # Download and save recs
     print(f'Downloading recs for {tic}...')
-    yf_rec_to_csv(tic,
-            pth=locs['rec_csv'],
-            start=cfg.START,
-            end=cfg.END)
+    df = fetch_rec(tic, start=cfg.START, end=cfg.END)
+    to_csv_atomic(df, locs['rec_csv'])
     print('Done')
 
 
+# --------------------------------------------------------
+#   Incremental price updates
+# --------------------------------------------------------
+def update_prc_csv(tic, fetch_prc=None, rtol=1e-6):
+    """ Updates the price CSV file for `tic`, downloading only the trading
+    days after the last date already in the file.
+
+    Parameters
+    ----------
+    tic : str
+        Ticker
+
+    fetch_prc : function, optional
+        See `get_data`
+
+    rtol : float, optional
+        Relative tolerance used to validate the overlap row. Defaults to 1e-6.
+
+    Returns
+    -------
+    int
+        Number of rows added to the file
+
+    Notes
+    -----
+    The download starts on the last date in the file (the "overlap" row).
+    If the prices for this date differ from the ones in the file (e.g., after
+    a stock split, since prices are adjusted) or if the columns are different,
+    the complete price history is downloaded again.
+    If the file does not exist, the complete price history is downloaded.
+    """
+    if fetch_prc is None:
+        fetch_prc = yf_fetch_prc
+    pth = cfg.csv_locs(tic)['prc_csv']
+
+    def _full():
+        df = fetch_prc(tic, start=cfg.START, end=cfg.END)
+        to_csv_atomic(df, pth)
+        return len(df)
+
+    if not os.path.exists(pth):
+        return _full()
+
+    # Prices already in the file
+    old = pd.read_csv(pth, index_col='Date', parse_dates=['Date'])
+    if len(old) == 0:
+        return _full()
+    last = old.index.max()
+
+    # Download from the last date in the file
+    new = fetch_prc(tic, start=last.strftime('%Y-%m-%d'), end=cfg.END)
+    new = new.loc[new.index >= last]
+    if len(new) == 0:
+        return 0
+
+    # Validate the overlap row
+    if list(new.columns) != list(old.columns) or last not in new.index:
+        print(f'{tic}: cannot validate the last stored date, downloading all prices')
+        return _full()
+    old_row = old.loc[[last]].iloc[-1].to_numpy(dtype=float)
+    new_row = new.loc[[last]].iloc[-1].to_numpy(dtype=float)
+    if not np.allclose(old_row, new_row, rtol=rtol, equal_nan=True):
+        print(f'{tic}: stored prices changed, downloading all prices')
+        return _full()
+
+    # Append the new rows
+    new = new.loc[new.index > last]
+    new.index.name = old.index.name
+    to_csv_atomic(new, pth, append=True)
+    return len(new)
+
+
+# --------------------------------------------------------
+#   Batch downloads
+# --------------------------------------------------------
+def get_data_batch(tics, max_workers=8, retries=3, backoff=1.0,
+                   fetch_prc=None, fetch_rec=None, incremental=False):
+    """ Downloads price and recommendation data for several tickers
+    concurrently (see `get_data`).
+
+    Parameters
+    ----------
+    tics : list of str
+        Tickers
+
+    max_workers : int, optional
+        Maximum number of tickers downloaded at the same time. Defaults to 8.
+
+    retries : int, optional
+        Number of times a failed download is retried. Defaults to 3.
+
+    backoff : float, optional
+        Seconds to wait before the first retry. The waiting time doubles after
+        each retry. Defaults to 1.0.
+
+    fetch_prc, fetch_rec : function, optional
+        See `get_data`
+
+    incremental : bool, optional
+        See `get_data`. Defaults to False.
+
+    Returns
+    -------
+    dict
+        A dictionary mapping each ticker to None (success) or to the
+        exception raised by the last attempt (failure)
+    """
+    def _get(tic):
+        for attempt in range(retries + 1):
+            try:
+                get_data(tic, fetch_prc=fetch_prc, fetch_rec=fetch_rec,
+                         incremental=incremental)
+                return None
+            except Exception as e:
+                if attempt == retries:
+                    print(f'Could not download data for {tic}: {e}')
+                    return e
+                time.sleep(backoff * 2 ** attempt)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        res = executor.map(_get, tics)
+        return dict(zip(tics, res))
+
+
+def to_csv_atomic(df, pth, append=False):
+    """ Saves the data frame `df` in the CSV file `pth`. The data is written
+    to a temporary file first, so `pth` is never left partially written.
+
+    If `append` is True, the rows of `df` are appended (without a header) to
+    a copy of the existing file instead.
+    """
+    tmp = f'{pth}.{os.getpid()}.{id(df)}.tmp'
+    try:
+        if append is True:
+            shutil.copyfile(pth, tmp)
+            df.to_csv(tmp, mode='a', header=False)
+        else:
+            df.to_csv(tmp)
+        os.replace(tmp, pth)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _test_get_data_batch():
+    """ Tests `get_data_batch` against local stand-ins for Yahoo Finance.
+    Files are saved to a temporary folder.
+    """
+    import tempfile
+    import threading
+
+    calls = {}
+    lock = threading.Lock()
+
+    def _fetch_prc(tic, start, end):
+        # Fails on the first call for each ticker
+        with lock:
+            calls[tic] = calls.get(tic, 0) + 1
+            n = calls[tic]
+        if n == 1:
+            raise ConnectionError('Temporary failure')
+        idx = pd.DatetimeIndex(['2020-01-02', '2020-01-03'], name='Date')
+        return pd.DataFrame({'Close': [1.0, 1.1]}, index=idx)
+
+    def _fetch_rec(tic, start, end):
+        idx = pd.DatetimeIndex(['2020-01-02 16:30:00'], name='Date')
+        return pd.DataFrame({'Firm': ['Some Firm'], 'Action': ['up']}, index=idx)
+
+    datadir = cfg.DATADIR
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg.DATADIR = tmpdir
+        try:
+            res = get_data_batch(['AAA', 'BBB'], backoff=0.01,
+                                 fetch_prc=_fetch_prc, fetch_rec=_fetch_rec)
+            print(res)
+            print(sorted(os.listdir(tmpdir)))
+        finally:
+            cfg.DATADIR = datadir
+
+
+def _test_update_prc_csv():
+    """ Tests `update_prc_csv` against a local stand-in for Yahoo Finance.
+    Files are saved to a temporary folder.
+    """
+    import tempfile
+
+    idx = pd.date_range('2020-01-01', periods=10, freq='B', name='Date')
+    prc = pd.DataFrame({'Close': np.arange(10.0), 'Volume': 100}, index=idx)
+    requested = []
+
+    def _fetch_prc(tic, start, end):
+        requested.append(start)
+        return prc.loc[start:end]
+
+    datadir = cfg.DATADIR
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg.DATADIR = tmpdir
+        try:
+            pth = cfg.csv_locs('AAA')['prc_csv']
+            prc.iloc[:6].to_csv(pth)
+            added = update_prc_csv('AAA', fetch_prc=_fetch_prc)
+            df = pd.read_csv(pth, index_col='Date', parse_dates=['Date'])
+            print(f'Requested from {requested[-1]}, added {added} rows')
+            print(df.equals(prc))
+        finally:
+            cfg.DATADIR = datadir
+
+
 if __name__ == "__main__":
-    get_data('tsla')
\ No newline at end of file
+    get_data('tsla')
@@ -0,0 +1,96 @@
+""" factors.py
+
+Utilities to read the Fama-French factors. The factors file is parsed once per
+process and shared across the pipeline.
+"""
+import os
+
+import pandas as pd
+
+import event_study.config as cfg
+from event_study import cache
+
+# --------------------------------------------------------
+#   Module-level cache
+# --------------------------------------------------------
+# Maps the (absolute) path of a factors file to a tuple
+# (mtime, start, end, dataframe)
+_CACHE = {}
+
+
+def get_ff_df(pth=None):
+    """ Returns the Fama-French factors between `cfg.START` and `cfg.END`.
+
+    The file is only parsed the first time this function is called (per
+    process). Later calls return the cached data unless the file has been
+    modified since it was read.
+
+    Parameters
+    ----------
+    pth : str, optional
+        Location of the CSV file with the factors. If None (the default),
+        `cfg.FF_FACTORS_CSV`
+
+    Returns
+    -------
+    dataframe
+        A data frame with the factors (columns 'mkt-rf', 'smb', 'hml', 'rf',
+        'mkt'), indexed by date
+
+    Notes
+    -----
+    All calls share the same underlying (read-only) array. Modifying the
+    data in place will raise an exception (or, under pandas copy-on-write,
+    modify a copy), so the cached data cannot be changed by accident.
+    """
+    if pth is None:
+        pth = cfg.FF_FACTORS_CSV
+    pth = os.path.abspath(pth)
+    mtime = os.stat(pth).st_mtime_ns
+
+    cached = _CACHE.get(pth)
+    if cached is None or cached[:3] != (mtime, cfg.START, cfg.END):
+        df = cache.read_cached(pth, read_ff_df, kind='ff')
+        df = df.loc[cfg.START:cfg.END]
+        # Store the data in a single read-only array
+        values = df.to_numpy(dtype=float)
+        values.setflags(write=False)
+        df = pd.DataFrame(values, index=df.index, columns=df.columns, copy=False)
+        cached = (mtime, cfg.START, cfg.END, df)
+        _CACHE[pth] = cached
+
+    # Return a view of the cached data
+    return cached[3].copy(deep=False)
+
+
+def read_ff_df(pth=None):
+    """ Reads the Fama-French factors in `pth` (no caching)
+
+    Parameters
+    ----------
+    pth : str, optional
+        Location of the CSV file with the factors. If None (the default),
+        `cfg.FF_FACTORS_CSV`
+
+    Returns
+    -------
+    dataframe
+        A data frame with the factors, indexed by date
+    """
+    if pth is None:
+        pth = cfg.FF_FACTORS_CSV
+    df = cfg.read_csv(pth, 'ff')
+    df.sort_index(inplace=True)
+    return df
+
+
+def clear_cache():
+    """ Removes all cached factor data
+    """
+    _CACHE.clear()
+
+
+if __name__ == "__main__":
+    df = get_ff_df()
+    print(df)
+    df.info()
@@ -0,0 +1,144 @@
+""" instrument.py
+
+Utilities to measure the time and memory used by each stage of a run (see
+`main.main`).
+
+Instrumentation is off by default. It is turned on by setting the
+environment variable `EVENT_STUDY_PROFILE` (see `config.PROFILE`) or by
+passing `profile=True`. When it is off, `start_run` returns None and `stage`
+does nothing but run its block.
+
+Usage:
+
+    run = start_run('main', tic='TSLA')
+    try:
+        with stage(run, 'mk_ret_df') as rec:
+            ret_df = mk_rets.mk_ret_df('TSLA')
+            rec['rows'] = len(ret_df)
+    finally:
+        end_run(run)
+
+`end_run` must be called even if a stage fails, otherwise tracemalloc keeps
+tracing (and slowing down) the rest of the process.
+
+`end_run` emits one JSON record per run with, for each stage, the wall time,
+CPU time, peak memory allocated by Python (tracemalloc) and any other
+values set in the block (e.g. row counts).
+"""
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import event_study.config as cfg
+
+
+def start_run(name, profile=None, **info):
+    """ Starts an instrumented run.
+
+    Parameters
+    ----------
+    name : str
+        Name of the run (e.g. 'main')
+
+    profile : bool, optional
+        If True, the run is instrumented. If None (the default),
+        `cfg.PROFILE`.
+
+    info
+        Other values to include in the record (e.g. the ticker)
+
+    Returns
+    -------
+    dict or None
+        The record of the run, or None if the run is not instrumented
+    """
+    if profile is None:
+        profile = cfg.PROFILE
+    if profile is not True:
+        return None
+    # Only stop tracemalloc at the end of the run if we started it
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    return {
+        'run': name,
+        **info,
+        'stages': [],
+        '_start': (time.perf_counter(), time.process_time()),
+        '_tracemalloc': started,
+        '_peak': 0,
+    }
+
+
+@contextmanager
+def stage(run, name):
+    """ Context manager measuring the stage `name` of the run `run` (see
+    `start_run`). Yields a dictionary where the block can store other values
+    for the stage, such as row counts. If `run` is None, nothing is measured.
+    """
+    rec = {'stage': name}
+    if run is None:
+        yield rec
+        return
+    tracemalloc.reset_peak()
+    mem0 = tracemalloc.get_traced_memory()[0]
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    try:
+        yield rec
+    finally:
+        rec['wall_s'] = time.perf_counter() - wall0
+        rec['cpu_s'] = time.process_time() - cpu0
+        peak = tracemalloc.get_traced_memory()[1]
+        rec['peak_mem_mb'] = (peak - mem0) / 2**20
+        # `reset_peak` discards the peak of earlier stages
+        run['_peak'] = max(run['_peak'], peak)
+        run['stages'].append(rec)
+
+
+def end_run(run, pth=None):
+    """ Ends the run `run` (see `start_run`) and emits its record as a single
+    line of JSON.
+
+    Parameters
+    ----------
+    run : dict or None
+        Record created by `start_run`. If None, nothing is done.
+
+    pth : str, optional
+        File where the record is appended. If None (the default),
+        `cfg.PROFILE_LOG` or, if this is also None, standard error.
+
+    Returns
+    -------
+    dict or None
+        The record (None if `run` is None)
+    """
+    if run is None:
+        return None
+    wall0, cpu0 = run.pop('_start')
+    run['wall_s'] = time.perf_counter() - wall0
+    run['cpu_s'] = time.process_time() - cpu0
+    peak = max(run.pop('_peak'), tracemalloc.get_traced_memory()[1])
+    run['peak_mem_mb'] = peak / 2**20
+    if run.pop('_tracemalloc'):
+        tracemalloc.stop()
+
+    line = json.dumps(run, default=_to_json)
+    if pth is None:
+        pth = cfg.PROFILE_LOG
+    if pth is None:
+        print(line, file=sys.stderr)
+    else:
+        with open(pth, 'a') as fobj:
+            fobj.write(line + '\n')
+    return run
+
+
+def _to_json(obj):
+    """ Converts numpy scalars (e.g. in `car_stats`) for `json.dumps`
+    """
+    if hasattr(obj, 'item'):
+        return obj.item()
+    return str(obj)
@@ -1,16 +1,24 @@
 """ main.py
 
 Main module for the event_study package. Will run the event study for a single
-stock.
+stock (`main`) or for several stocks at once (`main_panel` and
+`main_parallel`). `main_incremental` re-uses the CARs saved by previous runs.
 """
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import pandas as pd
+
 from event_study import download
+from event_study import instrument
 from event_study import mk_rets
 from event_study import mk_events
 from event_study import mk_cars
+from event_study import store
 from event_study import test_hypo
 
 
-def main(tic, update_csv=True):
+def main(tic, update_csv=True, profile=None):
     """ Implements the event study for a given stock ticker `tic`.
 
     Parameters
@@ -21,6 +29,11 @@ def main(tic, update_csv=True):
     update_csv : bool
         If True, data will be downloaded. Defaults to True.
 
+    profile : bool, optional
+        If True, the wall time, CPU time, peak memory and number of rows of
+        each step are emitted as a JSON record (see `instrument`). If None
+        (the default), `config.PROFILE`.
+
     Notes
     -----
     This function will perform the following tasks:
@@ -50,6 +63,180 @@ def main(tic, update_csv=True):
         The output of mk_cars.mk_cars_df(ret_df, event_df)
 
 
+    """
+    run = instrument.start_run('main', profile=profile, tic=tic)
+    # The record is emitted (and tracemalloc stopped) even if a step fails
+    try:
+        # Step 1: Download stock price and recommendation data for `tic`
+        with instrument.stage(run, 'download') as rec:
+            if update_csv is True:
+                download.get_data(tic)
+            else:
+                print("Parameter `update_csv` set to False, "
+                      "skipping downloads...")
+            rec['skipped'] = update_csv is not True
+
+        # Step 2: Create a data frame with stock (tic) and market returns
+        with instrument.stage(run, 'mk_ret_df') as rec:
+            ret_df = mk_rets.mk_ret_df(tic)
+            rec['rows'] = len(ret_df)
+
+        # Step 3: Create a data frame with the events
+        with instrument.stage(run, 'mk_event_df') as rec:
+            event_df = mk_events.mk_event_df(tic)
+            rec['rows'] = len(event_df)
+
+        # Step 4: Calculate CARs for each event
+        with instrument.stage(run, 'mk_cars_df') as rec:
+            cars_df = mk_cars.mk_cars_df(ret_df, event_df)
+            rec['rows'] = len(cars_df)
+            rec['car_stats'] = cars_df.attrs.get('car_stats')
+
+        # Step 5: Hypothesis testing using t-statistics
+        with instrument.stage(run, 'calc_tstats') as rec:
+            res = test_hypo.calc_tstats(cars_df)
+            rec['rows'] = len(res)
+        print(res)
+    finally:
+        instrument.end_run(run)
+
+
+def main_panel(tics, update_csv=True, window=2, window_type='calendar'):
+    """ Implements the event study for a list of stock tickers `tics`.
+
+    Parameters
+    ----------
+    tics : list of str
+        Tickers
+
+    update_csv : bool
+        If True, data will be downloaded. Defaults to True.
+
+    window : int, optional
+        Event window (see `mk_cars.mk_cars_df`). Defaults to 2.
+
+    window_type : str, optional
+        Either 'calendar' or 'trading' (see `mk_cars.mk_cars_df`). Defaults
+        to 'calendar'.
+
+    Returns
+    -------
+    tuple
+        Two dataframes with the output of `test_hypo.calc_tstats`: the first
+        with all events pooled and the second by ticker.
+
+    Notes
+    -----
+    Same steps as `main`, but:
+    - Returns for all tickers are stacked into a single panel
+      (`mk_rets.mk_panel_ret_df`) and the market returns are read once
+    - Events for all tickers are stacked into a single table
+      (`mk_events.mk_panel_event_df`)
+    - CARs for all events are computed in a single pass
+    - A RuntimeError is raised if the data of any ticker could not be
+      downloaded (after the retries of `download.get_data_batch`)
+    """
+    # Step 1: Download stock price and recommendation data. As in `main`,
+    # the run stops if the data of any ticker could not be downloaded
+    if update_csv is True:
+        errors = download.get_data_batch(tics)
+        failed = [tic for tic in tics if errors[tic] is not None]
+        if failed:
+            msg = f'Could not download data for {failed}'
+            raise RuntimeError(msg) from errors[failed[0]]
+    else:
+        print("Parameter `update_csv` set to False, skipping downloads...")
+
+    # Step 2: Create a panel with stock and market returns
+    ret_df = mk_rets.mk_panel_ret_df(tics)
+
+    # Step 3: Create a data frame with the events, keyed by ticker
+    event_df = mk_events.mk_panel_event_df(tics)
+
+    # Step 4: Calculate CARs for all events
+    cars_df = mk_cars.mk_cars_df(ret_df, event_df, window=window,
+                                 window_type=window_type)
+
+    # Step 5: Hypothesis testing using t-statistics (pooled and by ticker)
+    res = test_hypo.calc_tstats(cars_df)
+    res_tic = test_hypo.calc_tstats(cars_df, by='tic')
+    print(res)
+    print(res_tic)
+    return res, res_tic
+
+
+def main_parallel(tics, max_workers=None, update_csv=True, window=2,
+                  window_type='calendar'):
+    """ Implements the event study for a list of stock tickers `tics`,
+    processing each ticker in a separate worker process.
+
+    Parameters
+    ----------
+    tics : list of str
+        Tickers
+
+    max_workers : int, optional
+        Number of worker processes. If None (the default), the number of
+        processors on the machine.
+
+    update_csv : bool
+        If True, data will be downloaded. Defaults to True.
+
+    window : int, optional
+        Event window (see `mk_cars.mk_cars_df`). Defaults to 2.
+
+    window_type : str, optional
+        Either 'calendar' or 'trading' (see `mk_cars.mk_cars_df`). Defaults
+        to 'calendar'.
+
+    Returns
+    -------
+    tuple
+        Two dataframes with the output of `test_hypo.calc_tstats`: the first
+        with all events pooled and the second by ticker.
+
+    Notes
+    -----
+    Steps 1 to 4 of `main` run in the workers (see `_mk_tic_cars`), which
+    only send back the event types and CARs. The CARs are then merged in the
+    order of `tics`, so the results do not depend on `max_workers`.
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        cars = executor.map(_mk_tic_cars, tics,
+                            repeat(update_csv),
+                            repeat(window),
+                            repeat(window_type))
+        cars = list(cars)
+    cars_df = pd.concat(cars, keys=tics, names=['tic'])
+
+    # Step 5: Hypothesis testing using t-statistics (pooled and by ticker)
+    res = test_hypo.calc_tstats(cars_df)
+    res_tic = test_hypo.calc_tstats(cars_df, by='tic')
+    print(res)
+    print(res_tic)
+    return res, res_tic
+
+
+def main_incremental(tic, update_csv=True, window=2, window_type='calendar',
+                     model='mkt_adj', est_window=(-250, -30)):
+    """ Same as `main`, but only computes the CARs for events which are not
+    in the CAR store yet (see `store.update_cars`).
+
+    Parameters
+    ----------
+    tic : str
+        Ticker
+
+    update_csv : bool
+        If True, data will be downloaded. Defaults to True.
+
+    window, window_type, model, est_window :
+        See `mk_cars.mk_cars_df`
+
+    Returns
+    -------
+    dataframe
+        The output of `test_hypo.calc_tstats`
     """
     # Step 1: Download stock price and recommendation data for `tic`
     if update_csv is True:
@@ -57,18 +244,70 @@ def main(tic, update_csv=True):
     else:
         print("Parameter `update_csv` set to False, skipping downloads...")
 
-    # Step 2: Create a data frame with stock (tic) and market returns
-    ret_df = mk_rets.mk_ret_df(tic)
-
-    # Step 3: Create a data frame with the events
+    # Steps 2 and 3: Create the returns and events data frames
+    ret_df = mk_rets.mk_ret_df(tic, ff3=(model == 'ff3'),
+                               roll_beta=(model == 'mm_rolling'),
+                               est_window=est_window)
     event_df = mk_events.mk_event_df(tic)
 
-    # Step 4: Calculate CARs for each event
-    cars_df = mk_cars.mk_cars_df(ret_df, event_df)
+    # Step 4: Get CARs from the store, compute the missing ones
+    cars_df = store.update_cars(ret_df, event_df, tic, window=window,
+                                window_type=window_type, model=model,
+                                est_window=est_window)
 
     # Step 5: Hypothesis testing using t-statistics
     res = test_hypo.calc_tstats(cars_df)
     print(res)
+    return res
+
+
+def compact_mem_report(tics):
+    """ Compares the memory used by the returns, events and CARs data frames
+    for the tickers `tics` (as a panel) with and without compact dtypes.
+
+    Parameters
+    ----------
+    tics : list of str
+        Tickers
+
+    Returns
+    -------
+    dataframe
+        Memory (in bytes, including the index) for each data frame, with the
+        columns 'default', 'compact' and 'ratio' (compact / default)
+    """
+    def _mem(df):
+        return df.memory_usage(index=True, deep=True).sum()
+
+    res = {}
+    for compact in (False, True):
+        ret_df = mk_rets.mk_panel_ret_df(tics, compact=compact)
+        event_df = mk_events.mk_panel_event_df(tics, compact=compact)
+        cars_df = mk_cars.mk_cars_df(ret_df, event_df.copy(), compact=compact)
+        col = 'compact' if compact is True else 'default'
+        res[col] = {
+            'ret_df': _mem(ret_df),
+            'event_df': _mem(event_df),
+            'cars_df': _mem(cars_df),
+        }
+    res = pd.DataFrame(res)
+    res.loc['total'] = res.sum()
+    res.loc[:, 'ratio'] = res.loc[:, 'compact'] / res.loc[:, 'default']
+    print(res)
+    return res
+
+
+def _mk_tic_cars(tic, update_csv, window, window_type):
+    """ Steps 1 to 4 of `main` for a single ticker. Returns a data frame with
+    the columns 'event_type' and 'car', indexed by event_id.
+    """
+    if update_csv is True:
+        download.get_data(tic)
+    ret_df = mk_rets.mk_ret_df(tic)
+    event_df = mk_events.mk_event_df(tic)
+    cars_df = mk_cars.mk_cars_df(ret_df, event_df, window=window,
+                                 window_type=window_type)
+    return cars_df.loc[:, ['event_type', 'car']]
 
 
 if __name__ == "__main__":
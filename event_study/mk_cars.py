@@ -2,17 +2,32 @@
 
 Utilities to create CARs for the events in our study
 """
+import time
+
 import numpy as np
 import pandas as pd
 
 import event_study.config as cfg
 
+# Offset between the date keys of two consecutive tickers in a panel (see
+# `_mk_keys`). Must be larger than any date range (in days) in the sample.
+_TIC_STRIDE = 2 ** 32
+
+# Maximum number of events processed at once when estimating expected-return
+# models (bounds the memory used by the stacked estimation windows)
+_OLS_CHUNK = 10_000
+
+# Expected-return models (see `calc_cars`)
+MODELS = ('mkt_adj', 'mm', 'ff3', 'mm_rolling')
+
 
-def mk_cars_df(ret_df, event_df):
+def mk_cars_df(ret_df, event_df, window=2, window_type='calendar',
+               model='mkt_adj', est_window=(-250, -30), legacy=False,
+               compact=False, timing=False, est_stats=False, volume=False):
     """ Given a data frame with all events of interest for a given ticker
     (`event_df`) and the corresponding data frame with stock and market
     returns (`ret_df`), calculate the Cumulative Abnormal Return over the
-    two-day window surrounding each event.
+    `window`-day window surrounding each event.
 
     Parameters
     ----------
@@ -23,7 +38,9 @@ def mk_cars_df(ret_df, event_df):
                 Daily stock return
             mkt : float
                 Daily market return
-        The index is a DatetimeIndex corresponding to each trading day
+        The index is a DatetimeIndex corresponding to each trading day.
+        For panels (see `mk_rets.mk_panel_ret_df`), the index is a MultiIndex
+        with levels ('tic', 'Date')
 
     event_df : pandas dataframe
         Dataframe created by the function `mk_events.mk_event_df`. This data
@@ -37,6 +54,54 @@ def mk_cars_df(ret_df, event_df):
             event_type : str
                 A string identifying the event as either an upgrade
                 ("upgrade") or downgrade ("downgrade")
+        For panels (see `mk_events.mk_panel_event_df`), the index is a
+        MultiIndex with levels ('tic', 'event_id')
+
+    window : int, optional
+        Number of days before and after the event date included in the
+        event window. Defaults to 2.
+
+    window_type : str, optional
+        Either 'calendar' (the window includes `window` calendar days on each
+        side of the event date) or 'trading' (the window includes `window`
+        trading days on each side of the event date). See
+        `mk_cars.window_bounds`. Defaults to 'calendar'.
+
+    model : str, optional
+        Model of expected returns used to compute abnormal returns (see
+        `mk_cars.calc_cars`). Either 'mkt_adj' (market-adjusted returns), 'mm'
+        (market model), 'ff3' (Fama-French 3-factor model) or 'mm_rolling'
+        (market model precomputed in `ret_df`). Defaults to 'mkt_adj'.
+
+    est_window : tuple, optional
+        First and last trading days of the estimation window, relative to
+        day 0 of the event. Ignored if `model` is 'mkt_adj'. Defaults to
+        (-250, -30).
+
+    legacy : bool, optional
+        If True, apply the `mk_cars.calc_car` function to each row of the
+        `event_df` (slow, kept to verify the results of the batch engine).
+        Only available for market-adjusted returns, calendar windows and
+        single tickers. Defaults to False.
+
+    compact : bool, optional
+        If True, the column `car` is stored as float32 (CARs are always
+        computed in float64). Defaults to False.
+
+    timing : bool, optional
+        If True, print the time taken by `calc_cars`, the number of events and
+        the number of distinct (ticker, event date) windows actually computed.
+        Defaults to False.
+
+    est_stats : bool, optional
+        If True, also include the columns `sigma`, `df_est` and `n_win` (see
+        `calc_cars`), used by the standardized tests in `test_hypo`. Not
+        available with `legacy`. Defaults to False.
+
+    volume : bool, optional
+        If True, also include the column `cav` (see below). `ret_df` must
+        include abnormal volumes (see `mk_rets.mk_ret_df(..., volume=True)`).
+        Not available with `legacy`. Defaults to False.
 
     Returns
     -------
@@ -44,18 +109,747 @@ def mk_cars_df(ret_df, event_df):
         A data frame with the same format as `event_df` but with an additional
         column containing the CARs:
             car : float
-                The CAR for the two-day window surrounding the event
+                The CAR for the `window`-day window surrounding the event
+            cav : float
+                Only included if `volume` is True. The cumulative abnormal
+                (log) volume over the same window
 
     Notes
     -----
-    This function will apply the `mk_cars.calc_car` function to each row of the `event_df`
+    By default, CARs for all events are computed at once by the function
+    `mk_cars.calc_cars`. The statistics described in `calc_cars` are stored
+    in `event_df.attrs['car_stats']`.
 
     """
-    cars = event_df.apply(calc_car, axis=1, ret_df=ret_df)
+    if legacy is True:
+        if model != 'mkt_adj' or window_type != 'calendar' or _is_panel(ret_df):
+            raise ValueError('`legacy` requires market-adjusted returns, '
+                             'calendar event windows and a single ticker')
+        if est_stats is True:
+            raise ValueError('`est_stats` is not available with `legacy`')
+        if volume is True:
+            raise ValueError('`volume` is not available with `legacy`')
+        cars = event_df.apply(calc_car, axis=1, ret_df=ret_df, window=window)
+    else:
+        cars = calc_cars(ret_df, event_df, window=window,
+                         window_type=window_type, model=model,
+                         est_window=est_window, est_stats=est_stats,
+                         volume=volume)
+        event_df.attrs['car_stats'] = cars.attrs['car_stats']
+        if isinstance(cars, pd.DataFrame):
+            extra = cars.drop(columns='car')
+            cars = cars.loc[:, 'car']
+        if timing is True:
+            stats = cars.attrs['car_stats']
+            print(f"calc_cars: {stats['seconds']:.4f}s for {stats['n_events']:,} "
+                  f"events ({stats['n_unique']:,} unique windows, "
+                  f"dedup ratio {stats['dedup_ratio']:.2f})")
+    if compact is True:
+        cars = cars.astype('float32')
     event_df.loc[:, 'car'] = cars
+    if volume is True:
+        cav = extra.pop('cav')
+        event_df.loc[:, 'cav'] = cav.astype('float32') if compact is True else cav
+    if est_stats is True:
+        for col in ['sigma', 'df_est', 'n_win']:
+            event_df.loc[:, col] = extra.loc[:, col]
+    return event_df
+
+
+def calc_cars(ret_df, event_df, window=2, window_type='calendar',
+              model='mkt_adj', est_window=(-250, -30), est_stats=False,
+              volume=False):
+    """ Compute the cumulative abnormal returns for all events in `event_df`
+    in a single pass over the return arrays. For calendar windows and
+    market-adjusted returns, the result is the same as applying `calc_car`
+    to each row of `event_df`:
+
+    1. Map the first and last day of each event window to positions in the
+       (sorted) DatetimeIndex of `ret_df`. Events of the same ticker with the
+       same event date have the same CAR, so the following steps are only
+       performed once for each distinct (ticker, event date)
+    2. Estimate the expected-return model for all events at once (except for
+       market-adjusted returns)
+    3. Gather the abnormal returns between these positions
+    4. Sum the abnormal returns to compute the CAR
+
+    Parameters
+    ----------
+    ret_df : dataframe
+        A dataframe with stock and market returns (single ticker or panel)
+
+    event_df : dataframe
+        Dataframe produced by `mk_event_df` (or `mk_panel_event_df`)
+
+    window : int, optional
+        Number of days before and after the event date included in the event
+        window. Defaults to 2.
+
+    window_type : str, optional
+        Either 'calendar' or 'trading'. Defaults to 'calendar'.
+
+    model : str, optional
+        Model of expected returns. Defaults to 'mkt_adj'.
+        - 'mkt_adj': market-adjusted returns, aret = ret - mkt
+        - 'mm': market model, aret = ret - (a + b * mkt)
+        - 'ff3': Fama-French 3-factor model,
+          aret = ret - rf - (a + b1 * (mkt-rf) + b2 * smb + b3 * hml)
+          `ret_df` must include the factors (see `mk_rets.mk_ret_df`)
+        - 'mm_rolling': same as 'mm', but a and b are looked up on day 0 in
+          the columns 'alpha' and 'beta' of `ret_df` (see
+          `mk_rets.mk_ret_df(..., roll_beta=True)`) instead of estimated
+
+    est_window : tuple, optional
+        First and last trading days of the estimation window, relative to
+        day 0 of the event (see `window_bounds`). Ignored if `model` is
+        'mkt_adj' and `est_stats` is False. With 'mm_rolling', it must be the
+        window used to build `ret_df` (`ret_df.attrs['est_window']`).
+        Defaults to (-250, -30).
+
+    est_stats : bool, optional
+        If True, return a data frame with the CARs and the following
+        statistics (np.nan for events without a complete estimation window):
+            sigma : float
+                Standard deviation of the abnormal returns over the estimation
+                window (residual standard error of the model). For 'mkt_adj',
+                the abnormal returns are demeaned over the estimation window
+            df_est : int
+                Degrees of freedom of `sigma` (trading days in the estimation
+                window minus the number of model parameters, with 1 parameter
+                for 'mkt_adj')
+            n_win : int
+                Number of trading days in the event window
+        Defaults to False.
+
+    volume : bool, optional
+        If True, return a data frame with the CARs and the cumulative
+        abnormal volumes 'cav' (sum of the column 'avol' of `ret_df` over the
+        event window). Defaults to False.
+
+    Returns
+    -------
+    series
+        Cumulative abnormal return for each event, with the same index as
+        `event_df`. Events without any return in the window (or, for 'mm',
+        'ff3' and 'mm_rolling', without a complete estimation window) get
+        np.nan.
+        If `est_stats` or `volume` is True, a data frame (see above).
+        The attribute `attrs['car_stats']` is a dictionary with:
+            n_events : number of events
+            n_unique : number of distinct (ticker, event date)
+            dedup_ratio : n_events / n_unique
+            seconds : time taken
+
+    """
+    t0 = time.perf_counter()
+    if not ret_df.index.is_monotonic_increasing:
+        ret_df = ret_df.sort_index()
+
+    # --------------------------------------------------------
+    #   Step 1: Positions of the window in the return index
+    # --------------------------------------------------------
+    # Keys identify the (ticker, event date) of each event; only distinct
+    # keys are processed and the CARs are broadcast back to all events
+    ret_keys, event_keys, start, end = _mk_keys(ret_df, event_df)
+    event_keys, first, inverse = np.unique(event_keys, return_index=True,
+                                           return_inverse=True)
+    lo, hi, start, end, day0 = _key_bounds(ret_keys, event_keys, start[first],
+                                           end[first], window=window,
+                                           window_type=window_type)
+
+    # --------------------------------------------------------
+    #   Step 2: Estimate the expected-return model
+    # --------------------------------------------------------
+    # `y` is the return to be explained and `X` the regressors of the model
+    # (None for market-adjusted returns, where aret = y)
+    y, X = _model_arrays(ret_df, model)
+    if model == 'mm_rolling':
+        coefs, ssr = _lookup_estimates(ret_df, day0, start, end, est_window,
+                                       ok=hi > lo, ssr=est_stats)
+    else:
+        coefs, ssr = _estimate(y, X, day0, start, end, est_window, ok=hi > lo,
+                               ssr=est_stats)
+
+    # --------------------------------------------------------
+    #   Step 3: Gather abnormal returns for every event
+    # --------------------------------------------------------
+    # Each row of `pos` holds the 2 * window + 1 candidate positions of an
+    # event; positions at or beyond `hi` are outside the window
+    pos = lo[:, None] + np.arange(2 * window + 1)
+    inside = pos < hi[:, None]
+    arets = np.where(inside, _gather_arets(y, X, coefs, pos), 0.0)
+
+    # --------------------------------------------------------
+    #   Step 4: Sum abnormal returns
+    # --------------------------------------------------------
+    cars = arets.sum(axis=1)
+    # Same as `calc_car`: np.nan if there are no returns in the window
+    cars[hi == lo] = np.nan
+    res = {'car': cars}
+
+    # Abnormal volumes are summed over the same positions
+    if volume is True:
+        avols = np.where(inside, _gather_arets(_avol_array(ret_df), None,
+                                               None, pos), 0.0)
+        res['cav'] = avols.sum(axis=1)
+        res['cav'][hi == lo] = np.nan
+
+    if est_stats is True:
+        # For market-adjusted returns, one parameter (the mean abnormal
+        # return over the estimation window) is estimated
+        npar = 1 if X is None else X.shape[1]
+        df_est = est_window[1] - est_window[0] + 1 - npar
+        res['sigma'] = np.sqrt(ssr / df_est)
+        res['df_est'] = np.where(np.isnan(ssr), np.nan, df_est)
+        res['n_win'] = hi - lo
+
+    # Broadcast to all events
+    inverse = inverse.ravel()
+    if len(res) > 1:
+        cars = pd.DataFrame({k: v[inverse] for k, v in res.items()},
+                            index=event_df.index)
+    else:
+        cars = pd.Series(cars[inverse], index=event_df.index)
+    n_events = len(inverse)
+    n_unique = len(event_keys)
+    cars.attrs['car_stats'] = {
+        'n_events': n_events,
+        'n_unique': n_unique,
+        'dedup_ratio': n_events / n_unique if n_unique > 0 else np.nan,
+        'seconds': time.perf_counter() - t0,
+    }
+    return cars
+
+
+def mk_ar_df(ret_df, event_df, window=10, window_type='calendar',
+             model='mkt_adj', est_window=(-250, -30), as_frame=True):
+    """ Returns the abnormal returns of each event for each day in the event
+    window (events x event time), gathered from the return arrays for all
+    events at once.
+
+    Parameters
+    ----------
+    ret_df : dataframe
+        Dataframe created by the function `mk_rets.mk_ret_df` (or
+        `mk_rets.mk_panel_ret_df`)
+
+    event_df : dataframe
+        Dataframe created by the function `mk_events.mk_event_df` (or
+        `mk_events.mk_panel_event_df`)
+
+    window : int, optional
+        Event times go from -`window` to `window`. Defaults to 10.
+
+    window_type : str, optional
+        Either 'calendar' (event time in calendar days) or 'trading' (event
+        time in trading days, see `window_bounds`). Defaults to 'calendar'.
+
+    model, est_window :
+        See `calc_cars`
+
+    as_frame : bool, optional
+        If True (the default), return a data frame. Otherwise, return a
+        NumPy array.
+
+    Returns
+    -------
+    dataframe or array
+        A data frame with the same index as `event_df` and one column for
+        each event time (from -`window` to `window`), or the underlying array
+        with shape (len(event_df), 2 * window + 1).
+        Abnormal returns are np.nan for event times without a return
+        (e.g., weekends for calendar event times or days outside the sample)
+        and, for the 'mm', 'ff3' and 'mm_rolling' models, for events without
+        a complete estimation window. For trading event times, the whole row
+        is np.nan if the event window is not complete (as in `calc_cars`), so
+        row sums match the CARs of `mk_cars_df` with the same `window`.
+
+    """
+    if not ret_df.index.is_monotonic_increasing:
+        ret_df = ret_df.sort_index()
+
+    # Positions of each (event, event time) in the return arrays
+    ret_keys, event_keys, start, end = _mk_keys(ret_df, event_df)
+    day0 = ret_keys.searchsorted(event_keys, side='left')
+    event_time = np.arange(-window, window + 1)
+    if window_type == 'calendar':
+        keys = event_keys[:, None] + event_time
+        pos = ret_keys.searchsorted(keys, side='left')
+        found = np.minimum(pos, max(len(ret_keys) - 1, 0))
+        valid = (pos < len(ret_keys)) & (ret_keys[found] == keys)
+    elif window_type == 'trading':
+        pos = day0[:, None] + event_time
+        # Same rule as `window_bounds`: events whose window is not fully in
+        # the sample of the ticker get no abnormal returns
+        complete = (day0 - window >= start) & (day0 + window + 1 <= end)
+        valid = np.broadcast_to(complete[:, None], pos.shape)
+    else:
+        raise ValueError(f'Unknown value for `window_type`: {window_type}')
+
+    # Expected-return model and abnormal returns
+    y, X = _model_arrays(ret_df, model)
+    if model == 'mm_rolling':
+        coefs, _ = _lookup_estimates(ret_df, day0, start, end, est_window,
+                                     ok=valid.any(axis=1))
+    else:
+        coefs, _ = _estimate(y, X, day0, start, end, est_window,
+                             ok=valid.any(axis=1))
+    arets = np.where(valid, _gather_arets(y, X, coefs, pos), np.nan)
+
+    if as_frame is not True:
+        return arets
+    cols = pd.Index(event_time, name='event_time')
+    return pd.DataFrame(arets, index=event_df.index, columns=cols)
+
+
+def mk_aar_df(ar_df, event_df):
+    """ Computes the average abnormal returns (AAR) and cumulative average
+    abnormal returns (CAAR) by event type and event time.
+
+    Parameters
+    ----------
+    ar_df : dataframe
+        Output of `mk_ar_df`
+
+    event_df : dataframe
+        Dataframe with the column `event_type` (same index as `ar_df`)
+
+    Returns
+    -------
+    dataframe
+        A data frame with a MultiIndex (event_type, event_time) and the
+        columns:
+            aar : float
+                Average abnormal return across events
+            caar : float
+                Sum of the AARs from the first event time up to this event
+                time
+            n_obs : int
+                Number of events with an abnormal return
+    """
+    groups = ar_df.groupby(event_df.loc[:, 'event_type'], observed=True)
+    aar = groups.mean()
+    res = pd.DataFrame({
+        'aar': aar.stack(),
+        'caar': aar.cumsum(axis=1).stack(),
+        'n_obs': groups.count().stack(),
+    })
+    return res
+
+
+def mk_multi_cars_df(ret_df, event_df, windows=(1, 2, 5, 10),
+                     window_type='calendar'):
+    """ Same as `mk_cars_df`, but computes the CARs for several event windows
+    at once.
+
+    Parameters
+    ----------
+    ret_df : pandas dataframe
+        Dataframe created by the function `mk_rets.mk_ret_df`. If it includes
+        the column `cum_aret` (see `mk_rets.mk_ret_df(tic, cum_aret=True)`),
+        this column is used. Otherwise, it will be computed.
+
+    event_df : pandas dataframe
+        Dataframe created by the function `mk_events.mk_event_df`.
+
+    windows : list of int, optional
+        Event windows. Defaults to (1, 2, 5, 10).
+
+    window_type : str, optional
+        Either 'calendar' or 'trading'. Defaults to 'calendar'.
+
+    Returns
+    -------
+    Pandas dataframe
+        A data frame with the same format as `event_df` but with one
+        additional column for each window `w` in `windows`:
+            car_<w> : float
+                The CAR for the `w`-day window surrounding the event
+
+    Notes
+    -----
+    The abnormal returns are cumulated once. The CAR for any event and
+    any window is then the difference between two of these cumulative sums,
+    so the returns are not re-summed for each window.
+
+    A precomputed `cum_aret` may include returns before the first row of
+    `ret_df` (e.g., if `ret_df` is a slice). The CAR is therefore computed
+    as the cumulative sum on the last day of the window minus the
+    cumulative sum before the first day (`cum_aret - aret` on that day),
+    which does not depend on where the cumulation started.
+
+    """
+    from event_study import mk_rets
+
+    if not ret_df.index.is_monotonic_increasing:
+        ret_df = ret_df.sort_index()
+
+    if 'cum_aret' in ret_df.columns:
+        cum_aret = ret_df.loc[:, 'cum_aret']
+    else:
+        cum_aret = mk_rets.calc_cum_aret(ret_df)
+    # Cumulative sums up to and including (`incl`) and before (`excl`) each
+    # day, so incl[hi - 1] - excl[lo] is the sum of ret_df.iloc[lo:hi]
+    incl = cum_aret.to_numpy(dtype=float)
+    aret = (ret_df.loc[:, 'ret'].to_numpy(dtype=float)
+            - ret_df.loc[:, 'mkt'].to_numpy(dtype=float))
+    excl = incl - aret
+    last = max(len(incl) - 1, 0)
+
+    for w in windows:
+        lo, hi, *_ = _bounds(ret_df, event_df, window=w,
+                             window_type=window_type)
+        if len(incl) == 0:
+            cars = np.full(len(lo), np.nan)
+        else:
+            cars = (incl[np.clip(hi - 1, 0, last)]
+                    - excl[np.clip(lo, 0, last)])
+        cars[hi == lo] = np.nan
+        event_df.loc[:, f'car_{w}'] = cars
     return event_df
 
 
+def window_bounds(ret_df, event_df, window=2, window_type='calendar'):
+    """ Locates the event window of each event in `event_df` in the (sorted)
+    DatetimeIndex of `ret_df`, using a binary search for all events at once.
+
+    Parameters
+    ----------
+    ret_df : dataframe
+        A dataframe with stock and market returns, sorted by date (for
+        panels, sorted by ticker and date)
+
+    event_df : dataframe
+        Dataframe produced by `mk_event_df` (or `mk_panel_event_df`)
+
+    window : int, optional
+        Number of days before and after the event date included in the event
+        window. Defaults to 2.
+
+    window_type : str, optional
+        How the event window is defined. Defaults to 'calendar'.
+        - 'calendar': all trading days between `window` calendar days before
+          and `window` calendar days after the event date.
+        - 'trading': the `window` trading days before and after day 0, where
+          day 0 is the event date if it is a trading day or the next trading
+          day otherwise (e.g., for events on weekends and holidays). Windows
+          that are not fully covered by `ret_df` are treated as empty.
+
+    Returns
+    -------
+    tuple
+        Two integer arrays, `lo` and `hi`. For each event, `lo` is the
+        position of the first trading day in the window and `hi` is the
+        position immediately after the last one, so the window is
+        ret_df.iloc[lo:hi]. If there are no trading days in the window,
+        lo == hi.
+
+    Notes
+    -----
+    For panels, each event is only matched against the returns of its own
+    ticker. Events for tickers not in `ret_df` have empty windows.
+
+    """
+    lo, hi, *_ = _bounds(ret_df, event_df, window=window,
+                         window_type=window_type)
+    return lo, hi
+
+
+def window_complete(ret_df, event_df, window=2, window_type='calendar'):
+    """ Returns a boolean array which is True for events whose event window
+    has ended, i.e., the last day of the window is not after the last
+    trading day of the ticker in `ret_df`. CARs for these events will not
+    change when new returns are added to `ret_df`.
+
+    Parameters
+    ----------
+    ret_df, event_df, window, window_type :
+        See `window_bounds`
+
+    Returns
+    -------
+    array
+    """
+    lo, hi, start, end, day0 = _bounds(ret_df, event_df, window=window,
+                                       window_type=window_type)
+    if window_type == 'trading':
+        return day0 + window < end
+    # Calendar windows: compare dates
+    ret_dates = pd.DatetimeIndex(ret_df.index.get_level_values(-1))
+    event_dates = pd.DatetimeIndex(pd.to_datetime(event_df.loc[:, 'event_date']))
+    last = ret_dates.to_numpy()[np.maximum(end - 1, 0)]
+    win_end = (event_dates + pd.to_timedelta(window, unit='day')).to_numpy()
+    return (end > start) & (win_end <= last)
+
+
+def _bounds(ret_df, event_df, window, window_type):
+    """ Implements `window_bounds`. Also returns, for each event, the
+    position of the first return of its ticker (`start`), the position
+    immediately after the last return of its ticker (`end`) and the position
+    of day 0 (`day0`)
+    """
+    ret_keys, event_keys, start, end = _mk_keys(ret_df, event_df)
+    return _key_bounds(ret_keys, event_keys, start, end, window, window_type)
+
+
+def _key_bounds(ret_keys, event_keys, start, end, window, window_type):
+    """ Implements `_bounds` given the keys created by `_mk_keys`
+    """
+    # Position of day 0
+    day0 = ret_keys.searchsorted(event_keys, side='left')
+    if window_type == 'calendar':
+        lo = ret_keys.searchsorted(event_keys - window, side='left')
+        hi = ret_keys.searchsorted(event_keys + window, side='right')
+    elif window_type == 'trading':
+        lo = day0 - window
+        hi = day0 + window + 1
+        # Incomplete windows are empty
+        incomplete = (lo < start) | (hi > end)
+        lo[incomplete] = start[incomplete]
+        hi[incomplete] = start[incomplete]
+    else:
+        raise ValueError(f'Unknown value for `window_type`: {window_type}')
+    # Events for unknown tickers
+    unknown = start == end
+    lo[unknown] = start[unknown]
+    hi[unknown] = start[unknown]
+    return lo, hi, start, end, day0
+
+
+def _estimate(y, X, day0, start, end, est_window, ok, ssr=False):
+    """ Estimates the expected-return model for each event (see
+    `calc_cars`). Returns a tuple with:
+    - the coefficients, with shape (len(day0), k), or None for
+      market-adjusted returns (X is None)
+    - if `ssr` is True, the sum of squared abnormal returns over the
+      estimation window of each event (None otherwise). For market-adjusted
+      returns, the squares are taken about the mean abnormal return over
+      the estimation window
+
+    Only events where `ok` is True and the estimation window is complete
+    are estimated. The results for other events are np.nan.
+    """
+    if X is None and ssr is not True:
+        return None, None
+    est_lo = day0 + est_window[0]
+    est_hi = day0 + est_window[1] + 1
+    ok = ok & (est_lo >= start) & (est_hi <= end)
+    coefs = None
+    res_ssr = np.full(len(day0), np.nan) if ssr is True else None
+    if X is None:
+        # Abnormal returns are y: use the cumulative sums of y and y ** 2
+        # (sum of squares about the mean = Syy - Sy^2 / n)
+        n = est_window[1] - est_window[0] + 1
+        cum = np.concatenate([[0.0], np.cumsum(y)])
+        cum2 = np.concatenate([[0.0], np.cumsum(y ** 2)])
+        sy = cum[est_hi[ok]] - cum[est_lo[ok]]
+        syy = cum2[est_hi[ok]] - cum2[est_lo[ok]]
+        res_ssr[ok] = np.maximum(syy - sy ** 2 / n, 0.0)
+    else:
+        coefs = np.full((len(day0), X.shape[1]), np.nan)
+        if ssr is True:
+            coefs[ok], res_ssr[ok] = calc_ols(y, X, est_lo[ok], est_hi[ok],
+                                              return_ssr=True)
+        else:
+            coefs[ok] = calc_ols(y, X, est_lo[ok], est_hi[ok])
+    return coefs, res_ssr
+
+
+def _gather_arets(y, X, coefs, pos):
+    """ Returns the abnormal returns at the positions in `pos` (one row per
+    event). Positions outside the arrays are clipped, so the caller must
+    mask them.
+    """
+    if len(y) == 0:
+        return np.zeros(pos.shape)
+    pos = np.clip(pos, 0, len(y) - 1)
+    arets = y[pos]
+    if X is not None:
+        arets = arets - np.einsum('nwk,nk->nw', X[pos], coefs)
+    return arets
+
+
+def _lookup_estimates(ret_df, day0, start, end, est_window, ok, ssr=False):
+    """ Same as `_estimate` for the 'mm_rolling' model: the coefficients of
+    each event are the values of 'alpha' and 'beta' in `ret_df` on day 0
+    (see `mk_rets.calc_rolling_beta`), so no regression is run.
+
+    `est_window` must be the window used to compute the estimates, which
+    `mk_rets.mk_ret_df` records in `ret_df.attrs['est_window']`. It is only
+    used to convert the residual variance into a sum of squares.
+    """
+    missing = {'alpha', 'beta', 'resid_var'} - set(ret_df.columns)
+    if missing:
+        raise ValueError(f'`ret_df` does not include {sorted(missing)} '
+                         '(see `mk_rets.mk_ret_df(tic, roll_beta=True)`)')
+    used = ret_df.attrs.get('est_window')
+    if used is None:
+        raise ValueError('`ret_df` does not record the estimation window of '
+                         "'alpha' and 'beta' (see "
+                         '`mk_rets.mk_ret_df(tic, roll_beta=True)`)')
+    if tuple(used) != tuple(est_window):
+        raise ValueError(f'`est_window` {tuple(est_window)} differs from the '
+                         f'window used to estimate `ret_df` {tuple(used)}')
+    # Day 0 must be a trading day of the ticker of the event
+    ok = ok & (day0 >= start) & (day0 < end)
+    coefs = np.full((len(day0), 2), np.nan)
+    coefs[ok] = ret_df.loc[:, ['alpha', 'beta']].to_numpy(dtype=float)[day0[ok]]
+    res_ssr = None
+    if ssr is True:
+        n = est_window[1] - est_window[0] + 1
+        res_ssr = np.full(len(day0), np.nan)
+        resid_var = ret_df.loc[:, 'resid_var'].to_numpy(dtype=float)
+        res_ssr[ok] = resid_var[day0[ok]] * (n - 2)
+    return coefs, res_ssr
+
+
+def calc_ols(y, X, lo, hi, return_ssr=False):
+    """ Estimates the OLS regression of `y` on `X` separately for each
+    sample y[lo[i]:hi[i]], for all samples at once.
+
+    Parameters
+    ----------
+    y : array
+        Dependent variable (one value per trading day)
+
+    X : array
+        Regressors, with shape (len(y), k), including the constant
+
+    lo, hi : integer arrays
+        First and (one past the) last position of each sample. All samples
+        must have the same length
+
+    return_ssr : bool, optional
+        If True, also return the sum of squared residuals of each sample.
+        Defaults to False.
+
+    Returns
+    -------
+    array
+        Coefficients, with shape (len(lo), k). If `return_ssr` is True, a
+        tuple with the coefficients and the sums of squared residuals.
+
+    Notes
+    -----
+    The samples are stacked into arrays with shape (len(lo), hi - lo, k) and
+    the normal equations are solved for all samples at once. Events are
+    processed in chunks of `_OLS_CHUNK` to bound memory.
+    """
+    nobs = hi - lo
+    if len(nobs) > 0 and np.any(nobs != nobs[0]):
+        raise ValueError('All estimation windows must have the same length')
+    coefs = np.empty((len(lo), X.shape[1]))
+    ssr = np.empty(len(lo))
+    if len(lo) == 0:
+        return (coefs, ssr) if return_ssr is True else coefs
+    offsets = np.arange(nobs[0])
+    for first in range(0, len(lo), _OLS_CHUNK):
+        chunk = slice(first, first + _OLS_CHUNK)
+        pos = lo[chunk, None] + offsets
+        Xs = X[pos]
+        ys = y[pos]
+        XtX = np.einsum('nlk,nlj->nkj', Xs, Xs)
+        Xty = np.einsum('nlk,nl->nk', Xs, ys)
+        coefs[chunk] = np.einsum('nkj,nj->nk', np.linalg.pinv(XtX), Xty)
+        if return_ssr is True:
+            resid = ys - np.einsum('nlk,nk->nl', Xs, coefs[chunk])
+            ssr[chunk] = np.einsum('nl,nl->n', resid, resid)
+    if return_ssr is True:
+        return coefs, ssr
+    return coefs
+
+
+def _avol_array(ret_df):
+    """ Returns the abnormal volumes in `ret_df` as a float64 array (see
+    `mk_rets.mk_ret_df(..., volume=True)`)
+    """
+    if 'avol' not in ret_df.columns:
+        raise ValueError('Column `avol` not found in `ret_df` '
+                         '(see `mk_rets.mk_ret_df(..., volume=True)`)')
+    return ret_df.loc[:, 'avol'].to_numpy(dtype=float)
+
+
+def _model_arrays(ret_df, model):
+    """ Returns the arrays (y, X) for the expected-return model `model`,
+    where `y` is the return to be explained and `X` the regressors (including
+    a constant). For market-adjusted returns, X is None and y is the abnormal
+    return.
+    """
+    ret = ret_df.loc[:, 'ret'].to_numpy(dtype=float)
+    mkt = ret_df.loc[:, 'mkt'].to_numpy(dtype=float)
+    const = np.ones(len(ret))
+    if model == 'mkt_adj':
+        return ret - mkt, None
+    elif model in ('mm', 'mm_rolling'):
+        return ret, np.column_stack([const, mkt])
+    elif model == 'ff3':
+        missing = {'rf', 'mkt-rf', 'smb', 'hml'} - set(ret_df.columns)
+        if missing:
+            raise ValueError(f'`ret_df` does not include the factors {sorted(missing)} '
+                             '(see `mk_rets.mk_ret_df(tic, ff3=True)`)')
+        factors = ret_df.loc[:, ['mkt-rf', 'smb', 'hml']].to_numpy(dtype=float)
+        rf = ret_df.loc[:, 'rf'].to_numpy(dtype=float)
+        return ret - rf, np.column_stack([const, factors])
+    else:
+        raise ValueError(f'Unknown value for `model`: {model}')
+
+
+def _is_panel(ret_df):
+    """ Returns True if `ret_df` contains returns for several tickers
+    """
+    return isinstance(ret_df.index, pd.MultiIndex)
+
+
+def _mk_keys(ret_df, event_df):
+    """ Converts the dates in `ret_df` and `event_df` into integer keys, so
+    the returns of all tickers in a panel can be searched at once.
+
+    The key of a date is `code * _TIC_STRIDE + days`, where `code` is the
+    position of the ticker in the (sorted) list of tickers in `ret_df` and
+    `days` is the number of days since 1970-01-01.
+
+    Returns
+    -------
+    tuple
+        ret_keys : integer array (sorted)
+        event_keys : integer array
+        start : integer array with the position of the first return of the
+            ticker of each event
+        end : integer array with the position immediately after the last
+            return of the ticker of each event
+    """
+    event_dates = pd.DatetimeIndex(pd.to_datetime(event_df.loc[:, 'event_date']))
+    if _is_panel(ret_df):
+        ret_codes, tics = pd.factorize(ret_df.index.get_level_values('tic'),
+                                       sort=True)
+        if 'tic' in event_df.index.names:
+            event_tics = event_df.index.get_level_values('tic')
+        else:
+            event_tics = event_df.loc[:, 'tic']
+        event_codes = tics.get_indexer(event_tics)
+        ret_dates = pd.DatetimeIndex(ret_df.index.get_level_values(-1))
+    else:
+        ret_codes = np.zeros(len(ret_df), dtype=np.int64)
+        event_codes = np.zeros(len(event_df), dtype=np.int64)
+        ret_dates = pd.DatetimeIndex(ret_df.index)
+
+    def _days(dates):
+        return dates.to_numpy().astype('datetime64[D]').astype(np.int64)
+
+    ret_keys = ret_codes * _TIC_STRIDE + _days(ret_dates)
+    event_keys = event_codes * _TIC_STRIDE + _days(event_dates)
+
+    # Positions where the returns of each ticker start. Codes are sorted
+    # because `ret_df` is sorted by ticker.
+    ntics = ret_codes.max() + 1 if len(ret_codes) > 0 else 0
+    seg = np.searchsorted(ret_codes, np.arange(ntics + 1))
+    # Unknown tickers (code -1) get an empty segment
+    known = event_codes >= 0
+    start = np.where(known, seg[np.where(known, event_codes, 0)], 0)
+    end = np.where(known, seg[np.where(known, event_codes + 1, 0)], 0)
+    return ret_keys, event_keys, start, end
+
+
 def calc_car(ser, ret_df, window=2):
     """ For a given row in the dataframe produced by the `mk_event_df` function
     above, compute the cumulative abnormal returns for the event window
@@ -256,6 +1050,32 @@ def _test_mk_cars_df(sample_only=False):
     print(cars_df)
 
 
+def _test_mk_multi_cars_df():
+    """ Tests the function mk_multi_cars_df against mk_cars_df for each
+    window, on a slice of `ret_df` with a precomputed `cum_aret` (so the
+    cumulative sums do not start at zero) and on the full sample.
+    """
+    from event_study import mk_rets, mk_events
+
+    tic = 'TSLA'
+    event_df = mk_events.mk_event_df(tic)
+    full_df = mk_rets.mk_ret_df(tic, cum_aret=True)
+    windows = (1, 2, 5, 10)
+    for name, ret_df in [('sliced', full_df.loc['2020-09-21':'2020-09-25']),
+                         ('full', full_df)]:
+        for window_type in ['calendar', 'trading']:
+            multi = mk_multi_cars_df(ret_df, event_df.copy(), windows=windows,
+                                     window_type=window_type)
+            for w in windows:
+                cars = mk_cars_df(ret_df, event_df.copy(), window=w,
+                                  window_type=window_type)
+                if not np.allclose(multi.loc[:, f'car_{w}'], cars.loc[:, 'car'],
+                                   rtol=0, atol=1e-12, equal_nan=True):
+                    raise AssertionError(f'car_{w} differs from mk_cars_df '
+                                         f'({name}, {window_type})')
+    print('mk_multi_cars_df: OK')
+
+
 if __name__ == "__main__":
     sample_only = True
     _test_mk_cars_df(sample_only)
\ No newline at end of file
@@ -2,13 +2,15 @@
 
 Utilities to create events from recommendations
 """
+import numpy as np
 import pandas as pd
 
 import event_study.config as cfg
+from event_study import cache
 
 
 #   Functions to process recommendations into events
-def mk_event_df(tic):
+def mk_event_df(tic, legacy=False, compact=False, event_ts=False):
     """ Subsets and processes recommendations given a ticker and return a data
     frame with all events in the sample.
 
@@ -17,6 +19,18 @@ def mk_event_df(tic):
     tic : str
         Ticker
 
+    legacy : bool, optional
+        If True, process the recommendations using the original (row by row)
+        implementation. Defaults to False.
+
+    compact : bool, optional
+        If True, use compact dtypes (see `compact_event_df`). Defaults to
+        False.
+
+    event_ts : bool, optional
+        If True, include the column `event_ts` (see below), needed by
+        `shift_event_dates`. Not available with `legacy`. Defaults to False.
+
     Returns
     -------
     pandas dataframe
@@ -28,6 +42,9 @@ def mk_event_df(tic):
             Name of the firm (upper case)
         * event_type : string
             Either "downgrade" or "upgrade"
+        * event_ts : datetime64
+            Only included if `event_ts` is True. Timestamp of the
+            recommendation
 
         index: integer
             Index named 'event_id' starting at 1
@@ -49,12 +66,197 @@ def mk_event_df(tic):
     # ------------------------------------------------------------------------
     # Read the source file, set the column 'Date' as a DatetimeIndex
     pth = cfg.csv_locs(tic)['rec_csv']
-    df = pd.read_csv(pth, index_col='Date', parse_dates=['Date'])
+    df = cache.read_cached(pth, read_rec_csv, kind='rec')
 
-    # Standardise column names and keep only the columns of interest
+    # Keep only the columns of interest
     cols = ['firm', 'action']
-    df = cfg.standardise_colnames(df)[cols]
+    df = df[cols]
 
+    # ------------------------------------------------------------------------
+    # Steps 2 to 4
+    # ------------------------------------------------------------------------
+    if legacy is True:
+        if event_ts is True:
+            raise ValueError('`event_ts` is not available with `legacy`')
+        df = _mk_events_legacy(df)
+    else:
+        df = _mk_events(df, event_ts=event_ts)
+
+    if compact is True:
+        df = compact_event_df(df)
+    return df
+
+
+def compact_event_df(df):
+    """ Returns a copy of the events data frame `df` with compact dtypes:
+        * firm : category
+        * event_date : datetime64
+        * event_type : category
+    """
+    return df.astype({
+        'firm': 'category',
+        'event_date': 'datetime64[ns]',
+        'event_type': 'category',
+    })
+
+
+def _mk_events(df, event_ts=False):
+    """ Implements steps 2 to 4 of `mk_event_df` for the recommendations in
+    `df` (with columns 'firm' and 'action', indexed by date), using
+    vectorized operations only. If `event_ts` is True, the timestamp of each
+    event is included in the column 'event_ts'.
+
+    Notes
+    -----
+    Recommendations by the same firm with identical timestamps are ordered as
+    in the source file (the sort in the legacy implementation is not stable).
+    """
+    # ------------------------------------------------------------------------
+    # Step 2. Create variables identifying the firm and the event date
+    # ------------------------------------------------------------------------
+    # Firms are converted to integer codes. The upper case conversion is only
+    # applied to the distinct names, and codes follow the alphabetical order
+    # of the (upper case) names.
+    raw_codes, raw_firms = pd.factorize(df.loc[:, 'firm'])
+    firm_codes, firms = pd.factorize(raw_firms.str.upper(), sort=True)
+    firm_codes = np.where(raw_codes >= 0, firm_codes[raw_codes], -1)
+
+    # Timestamps and dates (as days since 1970-01-01) as integers. Dates are
+    # only converted to strings at the end.
+    ts = df.index.to_numpy().astype('datetime64[ns]')
+    days = ts.astype('datetime64[D]').astype(np.int64)
+
+    # ------------------------------------------------------------------------
+    # Step 3. Deal with multiple recommendations
+    # ------------------------------------------------------------------------
+    # Sort by (event_date, firm) and then by timestamp, and keep the last
+    # recommendation for each (event_date, firm), as `groupby(...).last()`
+    key = days * len(firms) + firm_codes
+    order = np.lexsort((ts.astype(np.int64), key))
+    order = order[firm_codes[order] >= 0]
+    is_last = np.append(key[order][1:] != key[order][:-1], True)
+    rows = order[is_last]
+
+    # ------------------------------------------------------------------------
+    # Step 4. Create a table with all relevant events
+    # ------------------------------------------------------------------------
+    # 4.1: Map each action to an event type. The mapping is computed once for
+    # each distinct action and then broadcast using the codes
+    action_codes, actions = pd.factorize(df.loc[:, 'action'].to_numpy()[rows])
+    actions = pd.Series(actions)
+    is_event = actions.str.contains('up|down').to_numpy(dtype=bool)
+    event_types = actions.map({'down': 'downgrade', 'up': 'upgrade'})
+    unknown = is_event & event_types.isna().to_numpy()
+    if unknown.any():
+        raise Exception(f'Unknown value for column `action`: {actions[unknown].iloc[0]}')
+
+    # 4.2: Keep the events
+    cond = (action_codes >= 0) & is_event[action_codes]
+    rows = rows[cond]
+    event_type = event_types.to_numpy()[action_codes[cond]]
+
+    # 4.3: Create the data frame with the event id index (starting at 1)
+    res = pd.DataFrame({
+        'firm': firms[firm_codes[rows]],
+        'event_date': np.datetime_as_string(days[rows].astype('datetime64[D]')),
+        'event_type': event_type,
+    })
+    if event_ts is True:
+        res.loc[:, 'event_ts'] = ts[rows]
+    res.index = res.index + 1
+    res.index.name = 'event_id'
+    return res
+
+
+# --------------------------------------------------------
+#   Intraday event timing
+# --------------------------------------------------------
+def shift_event_dates(event_df, ret_df, session=None):
+    """ Moves the date of each event to the trading session in which the
+    market could first react to it.
+
+    Each event is classified, using the time of its timestamp, as:
+        'pre_open' : before the open
+        'intraday' : between the open and the close
+        'after_close' : at or after the close
+
+    Pre-open and intraday events are assigned to the first trading day on
+    or after the date of the timestamp. After-close events are assigned to
+    the first trading day after that date.
+
+    Parameters
+    ----------
+    event_df : dataframe
+        Data frame with the events, including the column 'event_ts' (see
+        `mk_event_df(..., event_ts=True)`)
+
+    ret_df : dataframe
+        Data frame with the returns (see `mk_rets.mk_ret_df` or
+        `mk_rets.mk_panel_ret_df`). Its dates define the trading calendar.
+
+    session : dict, optional
+        Dictionary with the keys 'open' and 'close' (times as strings,
+        'HH:MM:SS'). If None (the default), `cfg.SESSION`.
+
+    Returns
+    -------
+    dataframe
+        A copy of `event_df` with the new event dates in 'event_date' (same
+        dtype as before) and the columns:
+            rec_date : date of the timestamp (same dtype as 'event_date')
+            session : 'pre_open', 'intraday' or 'after_close'
+
+    Notes
+    -----
+    - Timestamps are assumed to be in the time zone of the exchange.
+    - Events after the last date in `ret_df` keep the date of the
+      timestamp (plus one day if after the close).
+    - Events are not de-duplicated again: two recommendations by the same
+      firm may end up on the same date.
+    """
+    if 'event_ts' not in event_df.columns:
+        raise ValueError('Column `event_ts` not found (see `mk_event_df`)')
+    if session is None:
+        session = cfg.SESSION
+
+    # Trading calendar, as days since 1970-01-01 (sorted, unique)
+    dates = ret_df.index.get_level_values(-1)
+    cal = np.unique(dates.to_numpy().astype('datetime64[D]').astype(np.int64))
+
+    # Classify each timestamp using its time of day (in ns)
+    ts = event_df.loc[:, 'event_ts'].to_numpy().astype('datetime64[ns]')
+    day = ts.astype('datetime64[D]')
+    tod = (ts - day).astype(np.int64)
+    t_open = pd.Timedelta(session['open']).value
+    t_close = pd.Timedelta(session['close']).value
+    after = tod >= t_close
+    labels = np.where(after, 'after_close',
+                      np.where(tod < t_open, 'pre_open', 'intraday'))
+
+    # First trading day on or after the target day
+    target = day.astype(np.int64) + after
+    pos = np.searchsorted(cal, target)
+    new_day = np.where(pos < len(cal), cal[np.minimum(pos, len(cal) - 1)],
+                       target)
+
+    # Keep the dtype of 'event_date'
+    def _as_dates(days):
+        days = days.astype('datetime64[D]')
+        if pd.api.types.is_datetime64_any_dtype(event_df.loc[:, 'event_date']):
+            return days.astype('datetime64[ns]')
+        return np.datetime_as_string(days)
+
+    df = event_df.copy()
+    df.loc[:, 'rec_date'] = _as_dates(day.astype(np.int64))
+    df.loc[:, 'event_date'] = _as_dates(new_day)
+    df.loc[:, 'session'] = labels
+    return df
+
+
+def _mk_events_legacy(df):
+    """ Implements steps 2 to 4 of `mk_event_df` for the recommendations in
+    `df` (row by row). Kept to verify the results of `_mk_events`.
+    """
     # ------------------------------------------------------------------------
     # Step 2. Create variables identifying the firm and the event date
     # ------------------------------------------------------------------------
@@ -119,6 +321,94 @@ def mk_event_df(tic):
     return df
 
 
+def read_rec_csv(pth):
+    """ Reads the CSV file with recommendations `pth` into a data frame with
+    standardised column names, indexed by date. Only the columns in
+    `cfg.SCHEMAS['rec']` are read (see `cfg.read_csv`).
+    """
+    return cfg.read_csv(pth, 'rec')
+
+
+def mk_panel_event_df(tics, compact=False, event_ts=False):
+    """ Creates the events for several tickers and stacks them into a single
+    data frame.
+
+    Parameters
+    ----------
+    tics : list of str
+        Tickers
+
+    compact : bool, optional
+        If True, use compact dtypes (see `compact_event_df`). Defaults to
+        False.
+
+    event_ts : bool, optional
+        If True, include the column `event_ts` (see `mk_event_df`). Defaults
+        to False.
+
+    Returns
+    -------
+    pandas dataframe
+        Same columns as the output of `mk_event_df`, with a MultiIndex with
+        levels:
+            tic : str
+                Ticker
+            event_id : int
+                Event ID within the ticker (starting at 1)
+    """
+    dfs = [mk_event_df(tic, event_ts=event_ts) for tic in tics]
+    df = pd.concat(dfs, keys=tics, names=['tic'])
+    # Categories are only created after stacking, since concatenating
+    # categoricals with different categories produces object columns
+    if compact is True:
+        df = compact_event_df(df)
+    return df
+
+
+def _bench_mk_event_df(tic='TSLA', copies=100):
+    """ Compares the speed of the vectorized and legacy implementations of
+    steps 2 to 4 of `mk_event_df`.
+
+    Parameters
+    ----------
+    tic : str, optional
+        Ticker whose recommendations are used. Defaults to 'TSLA'.
+
+    copies : int, optional
+        The recommendations are replicated `copies` times (each copy shifted
+        by one day and with different firm names) to create a larger sample.
+        Defaults to 100.
+    """
+    import time
+
+    pth = cfg.csv_locs(tic)['rec_csv']
+    df = read_rec_csv(pth).loc[:, ['firm', 'action']]
+    dfs = []
+    for i in range(copies):
+        copy = df.copy()
+        copy.index = copy.index + pd.to_timedelta(i, unit='day')
+        copy.loc[:, 'firm'] = copy.loc[:, 'firm'] + f' {i}'
+        dfs.append(copy)
+    df = pd.concat(dfs)
+    # Drop recommendations with identical timestamps for the same firm, which
+    # the legacy implementation does not order consistently
+    dups = df.reset_index().duplicated(subset=['Date', 'firm'], keep='last')
+    df = df.loc[~dups.to_numpy()]
+
+    timings = {}
+    res = {}
+    for name, func in [('legacy', _mk_events_legacy), ('vectorized', _mk_events)]:
+        start = time.perf_counter()
+        res[name] = func(df.copy())
+        timings[name] = time.perf_counter() - start
+
+    same = res['legacy'].equals(res['vectorized'])
+    print(f'{len(df):,} recommendations, {len(res["vectorized"]):,} events')
+    print(f'legacy:     {timings["legacy"]:.4f}s')
+    print(f'vectorized: {timings["vectorized"]:.4f}s')
+    print(f'speedup:    {timings["legacy"] / timings["vectorized"]:.1f}x (same output: {same})')
+
+
 if __name__ == "__main__":
     tic = 'TSLA'
     df = mk_event_df(tic)
@@ -2,12 +2,17 @@
 
 Utilities to calculate stock and market returns
 """
+import numpy as np
 import pandas as pd
 
 import event_study.config as cfg
+from event_study import cache
+from event_study import factors
 
 # Function to read prices and calculate returns
-def mk_ret_df(tic):
+def mk_ret_df(tic, cum_aret=False, ff_df=None, ff3=False, compact=False,
+              volume=False, vol_window=(-250, -30), roll_beta=False,
+              est_window=(-250, -30)):
     """ Calculates return variables for the ticker `tic`
 
     Parameters
@@ -15,6 +20,40 @@ def mk_ret_df(tic):
     tic : str
         Ticker
 
+    cum_aret : bool, optional
+        If True, include the column `cum_aret` (see below). Defaults to False.
+
+    ff_df : dataframe, optional
+        Data frame with the market returns (column 'mkt') indexed by date.
+        If None (the default), the factors returned by `factors.get_ff_df`
+        (cached) are used.
+
+    ff3 : bool, optional
+        If True, include the Fama-French factors 'mkt-rf', 'smb', 'hml' and
+        'rf' (needed by the 'ff3' model in `mk_cars`). Defaults to False.
+
+    compact : bool, optional
+        If True, store returns and factors as float32 to save memory (see
+        `compact_ret_df`). Defaults to False.
+
+    volume : bool, optional
+        If True, include the column `avol` (see below). Defaults to False.
+
+    vol_window : tuple, optional
+        First and last trading days, relative to each day, of the window
+        used to compute the normal log volume (see `calc_abn_volume`).
+        Defaults to (-250, -30).
+
+    roll_beta : bool, optional
+        If True, include the columns `alpha`, `beta` and `resid_var` (see
+        below), needed by the 'mm_rolling' model in `mk_cars`. Defaults to
+        False.
+
+    est_window : tuple, optional
+        First and last trading days, relative to each day, of the window
+        used to estimate the market model (see `calc_rolling_beta`).
+        Defaults to (-250, -30).
+
     Returns
     -------
     dataframe
@@ -25,6 +64,19 @@ def mk_ret_df(tic):
                 Daily stock returns for this ticker `tic`
             mkt: float
                 Daily market returns
+            mkt-rf, smb, hml, rf: float
+                Only included if `ff3` is True. Daily Fama-French factors
+            cum_aret: float
+                Only included if `cum_aret` is True. Cumulative sum of the
+                abnormal returns (ret - mkt) up to and including each day.
+            avol: float
+                Only included if `volume` is True. Abnormal log volume (see
+                `calc_abn_volume`)
+            alpha, beta, resid_var: float
+                Only included if `roll_beta` is True. Market model estimated
+                over the `est_window` before each day (see
+                `calc_rolling_beta`). The window is recorded in
+                `attrs['est_window']`, which `mk_cars` checks.
 
     Notes
     -----
@@ -33,6 +85,7 @@ def mk_ret_df(tic):
     2. Read the CSV file into a data frame
     3. Calculate stock returns returns
     4. Join market returns
+    5. (Optional) Cumulate abnormal returns
 
     """
 
@@ -40,27 +93,215 @@ def mk_ret_df(tic):
     locs = cfg.csv_locs(tic)
     pth = locs['prc_csv']
 
-    # 2. Read the CSV file into a data frame
-    df = pd.read_csv(pth, index_col='Date', parse_dates=['Date'])
-    df = cfg.standardise_colnames(df)
+    # 2. Read the CSV file into a data frame (sorted by date)
+    df = cache.read_cached(pth, read_prc_csv, kind='prc')
 
     # 3. Calculate returns
-    df.sort_index(inplace=True)
     df.loc[:, 'ret'] = df.loc[:, 'close'].pct_change()
+    if volume is True:
+        df.loc[:, 'avol'] = calc_abn_volume(df.loc[:, 'volume'], vol_window)
 
     # 4. Join market returns
     # 4.1: Get market returns
-    ff_df = pd.read_csv(cfg.FF_FACTORS_CSV, index_col='Date', parse_dates=['Date'])
+    if ff_df is None:
+        ff_df = factors.get_ff_df()
     # 4.2: Inner join between `df` and `ff_df`.
     # Note that:
     #   a. We are only interested in two columns, 'mkt' and 'ret'
     #   b. We do not want any missing observations
     cols = ['mkt', 'ret']
-    df = df.join(ff_df, how='inner')[cols]
-    df.dropna(inplace=True)
+    if ff3 is True:
+        cols += ['mkt-rf', 'smb', 'hml', 'rf']
+    # Abnormal volumes can be missing (e.g., at the start of the sample)
+    extra = ['avol'] if volume is True else []
+    df = df.join(ff_df, how='inner')[cols + extra]
+    df.dropna(subset=cols, inplace=True)
+
+    # Rolling market model (on the trading days used by `mk_cars`)
+    if roll_beta is True:
+        df = df.join(calc_rolling_beta(df, est_window))
+
+    # 5. Cumulate abnormal returns
+    if cum_aret is True:
+        df.loc[:, 'cum_aret'] = calc_cum_aret(df)
+
+    if compact is True:
+        df = compact_ret_df(df)
+    if roll_beta is True:
+        df.attrs['est_window'] = tuple(est_window)
+    return df
+
+
+def calc_rolling_beta(ret_df, est_window=(-250, -30)):
+    """ Estimates the market model ret = alpha + beta * mkt + e for each day
+    t in `ret_df` (one ticker, sorted by date), using the returns on days
+    t + est_window[0] to t + est_window[1] (inclusive).
+
+    Parameters
+    ----------
+    ret_df : dataframe
+        Data frame with the columns 'ret' and 'mkt'
+
+    est_window : tuple, optional
+        First and last trading days of the estimation window, relative to
+        each day. Defaults to (-250, -30).
+
+    Returns
+    -------
+    dataframe
+        A data frame with the same index as `ret_df` and the columns 'alpha',
+        'beta' and 'resid_var' (residual variance, with n - 2 degrees of
+        freedom). Days without a complete estimation window get np.nan.
+
+    Notes
+    -----
+    The OLS estimates only depend on the sums of x, y, x^2, xy and y^2 over
+    the window (x = mkt, y = ret). These are computed for all days at once
+    with rolling sums, so the cost is O(n) regardless of the window length:
+
+        beta = (n * Sxy - Sx * Sy) / (n * Sxx - Sx^2)
+        alpha = (Sy - beta * Sx) / n
+        SSR = Syy - alpha * Sy - beta * Sxy
+    """
+    n = est_window[1] - est_window[0] + 1
+    x = ret_df.loc[:, 'mkt'].astype(float)
+    y = ret_df.loc[:, 'ret'].astype(float)
+
+    def _sum(ser):
+        # Sum over the window, aligned with the day it is used for
+        return ser.rolling(n).sum().shift(-est_window[1])
+
+    sx, sy = _sum(x), _sum(y)
+    sxx, sxy, syy = _sum(x * x), _sum(x * y), _sum(y * y)
+    beta = (n * sxy - sx * sy) / (n * sxx - sx ** 2)
+    alpha = (sy - beta * sx) / n
+    ssr = (syy - alpha * sy - beta * sxy).clip(lower=0)
+    return pd.DataFrame({'alpha': alpha, 'beta': beta,
+                         'resid_var': ssr / (n - 2)})
+
+
+def calc_abn_volume(volume, vol_window=(-250, -30)):
+    """ Returns the abnormal log volume for each day in the series `volume`
+    (one ticker, sorted by date).
+
+    The abnormal log volume on day t is log(1 + volume) minus its mean over
+    the trading days t + vol_window[0] to t + vol_window[1] (inclusive). It
+    is np.nan if any volume in this window is missing.
+
+    Notes
+    -----
+    The mean is a rolling mean over the window length, lagged so the window
+    ends on day t + vol_window[1].
+    """
+    log_vol = np.log1p(volume)
+    n = vol_window[1] - vol_window[0] + 1
+    normal = log_vol.rolling(n).mean().shift(-vol_window[1])
+    return log_vol - normal
+
 
+def compact_ret_df(df):
+    """ Returns a copy of the returns data frame `df` where returns and
+    factors are stored as float32.
+
+    Notes
+    -----
+    The column `cum_aret` (if present) is kept as float64, since CARs are
+    differences between its values. Calculations in `mk_cars` are always
+    performed in float64.
+    """
+    dtypes = {c: 'float32' for c in df.columns if c != 'cum_aret'}
+    return df.astype(dtypes)
+
+
+def read_prc_csv(pth):
+    """ Reads the CSV file with prices `pth` into a data frame with
+    standardised column names, indexed and sorted by date. Only the columns in
+    `cfg.SCHEMAS['prc']` are read (see `cfg.read_csv`).
+    """
+    df = cfg.read_csv(pth, 'prc')
+    df.sort_index(inplace=True)
+    return df
+
+
+def mk_panel_ret_df(tics, cum_aret=False, ff3=False, compact=False,
+                    volume=False, roll_beta=False, est_window=(-250, -30)):
+    """ Calculates return variables for several tickers and stacks them into
+    a single (long) data frame. The market returns are read only once.
+
+    Parameters
+    ----------
+    tics : list of str
+        Tickers
+
+    cum_aret : bool, optional
+        If True, include the column `cum_aret`, cumulated separately for each
+        ticker. Defaults to False.
+
+    ff3 : bool, optional
+        If True, include the Fama-French factors. Defaults to False.
+
+    compact : bool, optional
+        If True, store returns and factors as float32. Defaults to False.
+
+    volume : bool, optional
+        If True, include the abnormal log volume `avol` (see `mk_ret_df`).
+        Defaults to False.
+
+    roll_beta, est_window : optional
+        See `mk_ret_df`. The market model is estimated separately for each
+        ticker.
+
+    Returns
+    -------
+    dataframe
+        Same columns as the output of `mk_ret_df`, with a MultiIndex with
+        levels:
+            tic : str
+                Ticker
+            Date : datetime
+                Trading day
+        The data frame is sorted by ticker and date
+    """
+    ff_df = factors.get_ff_df()
+    dfs = [mk_ret_df(tic, cum_aret=cum_aret, ff_df=ff_df, ff3=ff3,
+                     compact=compact, volume=volume, roll_beta=roll_beta,
+                     est_window=est_window)
+           for tic in tics]
+    df = pd.concat(dfs, keys=tics, names=['tic'])
+    df.sort_index(inplace=True)
+    if roll_beta is True:
+        df.attrs['est_window'] = tuple(est_window)
     return df
 
+
+def calc_cum_aret(ret_df):
+    """ Returns the cumulative sum of the abnormal returns (ret - mkt) in
+    `ret_df`.
+
+    Parameters
+    ----------
+    ret_df : dataframe
+        Dataframe created by the function `mk_ret_df`
+
+    Returns
+    -------
+    series
+        Series with the same index as `ret_df`. For panels (see
+        `mk_panel_ret_df`), abnormal returns are cumulated separately for
+        each ticker.
+
+    Notes
+    -----
+    The sum of the abnormal returns between two positions `lo` and `hi`
+    (ret_df.iloc[lo:hi]) is the difference between two values of this
+    series: cum_aret[hi-1] - cum_aret[lo-1] (with cum_aret[-1] = 0).
+    """
+    aret = ret_df.loc[:, 'ret'] - ret_df.loc[:, 'mkt']
+    if isinstance(ret_df.index, pd.MultiIndex):
+        return aret.groupby(level='tic', sort=False).cumsum()
+    return aret.cumsum()
+
+
 if __name__ == "__main__":
     tic = 'TSLA'
     df = mk_ret_df(tic)
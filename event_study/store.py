@@ -0,0 +1,165 @@
+""" store.py
+
+Persisted CARs, so event studies can be re-run incrementally (see
+`main.main_incremental`).
+
+The store is a CSV file (`cfg.CARS_STORE_CSV` by default) with one row for each
+combination of:
+    tic : str
+        Ticker
+    event_hash : int
+        Hash of the content of the event (ticker, firm, event date and event
+        type). Unlike the `event_id`, it does not change when new
+        recommendations are added to the source data.
+    window : int
+        Event window
+    window_type : str
+        'calendar' or 'trading'
+    model : str
+        Expected-return model (including the estimation window, if any)
+
+Only CARs for events whose window has ended are stored. If a key appears
+more than once (e.g. two runs saved the same CARs), the last row is used.
+"""
+import os
+import shutil
+
+import pandas as pd
+
+import event_study.config as cfg
+from event_study import mk_cars
+
+KEY_COLS = ['tic', 'event_hash', 'window', 'window_type', 'model']
+
+
+def update_cars(ret_df, event_df, tic, window=2, window_type='calendar',
+                model='mkt_adj', est_window=(-250, -30), pth=None):
+    """ Returns the CARs for the events in `event_df`, computing only the
+    CARs which are not in the store yet, and saves the new (complete) CARs.
+
+    Parameters
+    ----------
+    ret_df : dataframe
+        Output of `mk_rets.mk_ret_df`
+
+    event_df : dataframe
+        Output of `mk_events.mk_event_df`
+
+    tic : str
+        Ticker
+
+    window, window_type, model, est_window :
+        See `mk_cars.mk_cars_df`
+
+    pth : str, optional
+        Location of the store. If None (the default), `cfg.CARS_STORE_CSV`
+
+    Returns
+    -------
+    dataframe
+        Same as `mk_cars.mk_cars_df(ret_df, event_df, ...)`
+    """
+    if pth is None:
+        pth = cfg.CARS_STORE_CSV
+    mkey = model_key(model, est_window)
+
+    # Hash the events and look up the stored CARs for this ticker/window/model
+    hashes = event_hashes(event_df, tic)
+    stored = read_store(pth)
+    cond = ((stored.loc[:, 'tic'] == tic)
+            & (stored.loc[:, 'window'] == window)
+            & (stored.loc[:, 'window_type'] == window_type)
+            & (stored.loc[:, 'model'] == mkey))
+    stored = stored.loc[cond].set_index('event_hash').loc[:, 'car']
+    known = hashes.isin(stored.index).to_numpy()
+
+    # Compute the CARs for the other events
+    new_df = mk_cars.mk_cars_df(ret_df, event_df.loc[~known].copy(),
+                                window=window, window_type=window_type,
+                                model=model, est_window=est_window)
+
+    # Save the new CARs for events whose window has ended
+    complete = mk_cars.window_complete(ret_df, new_df, window=window,
+                                       window_type=window_type)
+    to_store = pd.DataFrame({
+        'tic': tic,
+        'event_hash': hashes.loc[~known].to_numpy()[complete],
+        'window': window,
+        'window_type': window_type,
+        'model': mkey,
+        'car': new_df.loc[:, 'car'].to_numpy()[complete],
+    })
+    append_store(to_store, pth)
+    print(f'{tic}: {known.sum()} CARs from the store, {len(new_df)} computed, '
+          f'{len(to_store)} saved')
+
+    # Merge stored and new CARs
+    cars = pd.Series(stored.reindex(hashes).to_numpy(), index=event_df.index)
+    cars.loc[~known] = new_df.loc[:, 'car']
+    event_df.loc[:, 'car'] = cars
+    return event_df
+
+
+def event_hashes(event_df, tic):
+    """ Returns a series (same index as `event_df`) with the hash of the
+    content of each event
+    """
+    content = pd.DataFrame({
+        'tic': tic,
+        'firm': event_df.loc[:, 'firm'].to_numpy(),
+        'event_date': pd.to_datetime(event_df.loc[:, 'event_date']).to_numpy(),
+        'event_type': event_df.loc[:, 'event_type'].to_numpy(),
+    })
+    hashes = pd.util.hash_pandas_object(content, index=False).to_numpy()
+    # Stored as signed integers so they survive the round trip to CSV
+    return pd.Series(hashes.view('int64'), index=event_df.index)
+
+
+def model_key(model, est_window):
+    """ Returns a string identifying the expected-return model
+    """
+    if model == 'mkt_adj':
+        return model
+    return f'{model}[{est_window[0]},{est_window[1]}]'
+
+
+def read_store(pth=None):
+    """ Reads the store into a data frame (empty if the store does not exist).
+    Repeated keys are dropped, keeping the last row.
+    """
+    if pth is None:
+        pth = cfg.CARS_STORE_CSV
+    if not os.path.exists(pth):
+        return pd.DataFrame({
+            'tic': pd.Series(dtype=str),
+            'event_hash': pd.Series(dtype='int64'),
+            'window': pd.Series(dtype='int64'),
+            'window_type': pd.Series(dtype=str),
+            'model': pd.Series(dtype=str),
+            'car': pd.Series(dtype=float),
+        })
+    # CARs are read back exactly as they were computed
+    df = pd.read_csv(pth, dtype={'tic': str, 'event_hash': 'int64'},
+                     float_precision='round_trip')
+    return df.drop_duplicates(subset=KEY_COLS, keep='last')
+
+
+def append_store(df, pth=None):
+    """ Appends the rows in `df` to the store. The rows are appended to a
+    temporary copy of the store, which then replaces it, so the store is
+    never left with a partially written row.
+    """
+    if pth is None:
+        pth = cfg.CARS_STORE_CSV
+    if len(df) == 0:
+        return
+    header = not os.path.exists(pth)
+    tmp = f'{pth}.{os.getpid()}.{id(df)}.tmp'
+    try:
+        if not header:
+            shutil.copyfile(pth, tmp)
+        df.to_csv(tmp, mode='a', header=header, index=False)
+        os.replace(tmp, pth)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -2,12 +2,14 @@
 
 Utilities to test the hypothesis in the study
 """
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 # --------------------------------------------------------
 #   Function to calculate t-stats
 # --------------------------------------------------------
-def calc_tstats(event_cars):
+def calc_tstats(event_cars, by=None, cluster=None, col='car'):
     """ Compute a t-stat for each event type in the dataframe `event_df`.
 
     Parameters
@@ -15,9 +17,38 @@ def calc_tstats(event_cars):
     event_cars : dataframe
         Dataframe with event types and CARs for each event in the sample.
 
+    by : str, optional
+        Name of a column (or index level) in `event_cars`, e.g. 'tic' for
+        panels. If given, t-stats are computed separately for each value of
+        this column. If None (the default), all events are pooled.
+
+    cluster : str or list of str, optional
+        Name of one or two columns (or index levels) in `event_cars` used to
+        cluster the standard errors, e.g. 'event_date' or, for two-way
+        clustering by date and stock, ['event_date', 'tic']. If given, the
+        columns 'car_se_cl', 'car_t_cl' and 'n_cl' are also included (see
+        `calc_cluster_se`). Defaults to None.
+
+    col : str, optional
+        Column to test, e.g. 'cav' for cumulative abnormal volumes (see
+        `mk_cars.mk_cars_df(..., volume=True)`). Defaults to 'car'.
+
+    Returns
+    -------
+    dataframe
+        A data frame with one row per event type and the columns 'car_bar'
+        (mean CAR), 'car_t' (t-stat) and 'n_obs' (number of events).
+        If `event_cars` includes the columns 'sigma', 'df_est' and 'n_win'
+        (see `mk_cars.mk_cars_df(..., est_stats=True)`), the standardized
+        tests 'patell_z' and 'bmp_t' are also included (see
+        `calc_std_tests`).
+        If `col` is not 'car', the columns are named after `col` (e.g.
+        'cav_bar' and 'cav_t') and the standardized tests are not included.
+
     """
     # Separate between upgrades and downgrades
-    groups = event_cars.groupby('event_type')['car']
+    keys = 'event_type' if by is None else [by, 'event_type']
+    groups = event_cars.groupby(keys, observed=True)[col]
     print(groups.describe())
     # Mean
     car_bar = groups.mean()
@@ -27,5 +58,339 @@ def calc_tstats(event_cars):
     # collect the number of obs in each group
     car_n = groups.count()
     # Construct the result data frame
-    res = pd.DataFrame({'car_bar':car_bar, 'car_t': car_t, 'n_obs': car_n})
+    res = pd.DataFrame({f'{col}_bar': car_bar, f'{col}_t': car_t,
+                        'n_obs': car_n})
+    # Standardized tests
+    if col == 'car' and {'sigma', 'df_est', 'n_win'}.issubset(event_cars.columns):
+        res = res.join(calc_std_tests(event_cars, by=by))
+    # Clustered standard errors
+    if cluster is not None:
+        res = res.join(calc_cluster_se(event_cars, cluster, by=by, col=col))
+    return res
+
+
+# --------------------------------------------------------
+#   Clustered standard errors
+# --------------------------------------------------------
+def calc_cluster_se(event_cars, cluster, by=None, col='car'):
+    """ Compute clustered standard errors for the mean CAR of each event type
+    in `event_cars`.
+
+    Parameters
+    ----------
+    event_cars : dataframe
+        Dataframe with event types and CARs for each event in the sample.
+
+    cluster : str or list of str
+        Name of one or two columns (or index levels) in `event_cars` defining
+        the clusters, e.g. 'event_date' or ['event_date', 'tic'].
+
+    by, col : str, optional
+        See `calc_tstats`
+
+    Returns
+    -------
+    dataframe
+        A data frame with one row per event type and the columns (named
+        after `col`):
+            car_se_cl : clustered standard error of the mean CAR
+            car_t_cl : t-stat using `car_se_cl`
+            n_cl : number of clusters (the smallest number if two-way)
+
+    Notes
+    -----
+    With one cluster dimension, the variance of the mean CAR is
+
+        G/(G-1) * sum_c (sum_{i in c} e_i)^2 / N^2
+
+    where e_i is the CAR of event i minus the mean CAR, N is the number of
+    events and G the number of clusters. With two dimensions (e.g. date
+    and stock), the variance is V_date + V_stock - V_date_stock, where
+    V_date_stock clusters by the intersection of both (Cameron, Gelbach
+    and Miller, 2011). A negative two-way variance, or a single cluster,
+    gives np.nan.
+
+    Sums by cluster are computed with `np.bincount` over integer cluster
+    codes, so no events x clusters matrix is built.
+    """
+    if isinstance(cluster, str):
+        cluster = [cluster]
+    if len(cluster) not in (1, 2):
+        raise ValueError(f'Expected one or two cluster columns, got {cluster}')
+
+    # Integer code for each group of events (-1 if a key is missing)
+    keys = 'event_type' if by is None else [by, 'event_type']
+    groups = event_cars.groupby(keys, observed=True)
+    index = groups.size().index
+    gcode = groups.ngroup().to_numpy()
+    n_groups = len(index)
+
+    # Integer code for each cluster (-1 if missing)
+    ccodes = [pd.factorize(_get_col(event_cars, c))[0] for c in cluster]
+    if len(cluster) == 2:
+        both = ccodes[0].astype(np.int64) * _n_codes(ccodes[1]) + ccodes[1]
+        ccodes.append(np.where((ccodes[0] < 0) | (ccodes[1] < 0), -1,
+                               pd.factorize(both)[0]))
+    signs = [1.0, 1.0, -1.0][:len(ccodes)]
+
+    # Keep events with a CAR, a group and all cluster keys
+    car = event_cars.loc[:, col].to_numpy(dtype=float)
+    ok = ~np.isnan(car) & (gcode >= 0)
+    for codes in ccodes:
+        ok &= codes >= 0
+    car, gcode = car[ok], gcode[ok]
+
+    # Deviations from the group mean
+    n = np.bincount(gcode, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        car_bar = np.bincount(gcode, weights=car, minlength=n_groups) / n
+    e = car - car_bar[gcode]
+
+    var = np.zeros(n_groups)
+    n_cl = None
+    for sign, codes in zip(signs, ccodes):
+        # Pairs (group, cluster). The stride is taken from all the codes, so
+        # it is defined even if no event is kept.
+        stride = _n_codes(codes)
+        codes = codes[ok].astype(np.int64)
+        pairs, pair_id = np.unique(gcode * stride + codes,
+                                   return_inverse=True)
+        pair_group = pairs // stride
+        # Sum of deviations by pair, then sum of squares by group
+        e_sum = np.bincount(pair_id.ravel(), weights=e, minlength=len(pairs))
+        g = np.bincount(pair_group, minlength=n_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            adj = np.where(g > 1, g / (g - 1), np.nan)
+            var += sign * (adj * np.bincount(pair_group, weights=e_sum ** 2,
+                                         minlength=n_groups) / n ** 2)
+        if sign > 0:
+            n_cl = g if n_cl is None else np.minimum(n_cl, g)
+
+    car_se = np.sqrt(np.where(var > 0, var, np.nan))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        car_t = car_bar / car_se
+    return pd.DataFrame({f'{col}_se_cl': car_se, f'{col}_t_cl': car_t,
+                         'n_cl': n_cl}, index=index)
+
+
+def _n_codes(codes):
+    """ Returns the number of distinct codes in the output of `pd.factorize`
+    (at least 1)
+    """
+    return max(int(codes.max()) + 1, 1) if len(codes) > 0 else 1
+
+
+def _get_col(df, name):
+    """ Returns the column (or index level) `name` of `df` as an array
+    """
+    if name in df.columns:
+        return df.loc[:, name].to_numpy()
+    return df.index.get_level_values(name).to_numpy()
+
+
+# --------------------------------------------------------
+#   Standardized-residual tests
+# --------------------------------------------------------
+def calc_std_tests(event_cars, by=None):
+    """ Compute the Patell and Boehmer-Musumeci-Poulsen (BMP) tests for each
+    event type in `event_cars`.
+
+    Parameters
+    ----------
+    event_cars : dataframe
+        Dataframe with the columns 'event_type', 'car', 'sigma', 'df_est' and
+        'n_win' (see `mk_cars.mk_cars_df(..., est_stats=True)`).
+
+    by : str, optional
+        See `calc_tstats`
+
+    Returns
+    -------
+    dataframe
+        A data frame with one row per event type and the columns:
+            patell_z : Patell Z statistic
+            bmp_t : BMP t-statistic
+            n_std : number of events with a complete estimation window
+
+    Notes
+    -----
+    Each CAR is standardized by its standard deviation under the null,
+    estimated from the abnormal returns in the estimation window:
+
+        scar = car / (sigma * sqrt(n_win))
+
+    The variance of `scar` is df_est / (df_est - 2). The Patell Z statistic
+    is sum(scar) / sqrt(sum(df_est / (df_est - 2))). The BMP statistic is the
+    t-stat of the mean `scar`, using the cross-sectional standard deviation
+    of `scar`.
+    """
+    scar = event_cars.loc[:, 'car'] / (event_cars.loc[:, 'sigma']
+                                       * np.sqrt(event_cars.loc[:, 'n_win']))
+    df_est = event_cars.loc[:, 'df_est']
+    scar_var = (df_est / (df_est - 2)).where(scar.notna())
+
+    keys = 'event_type' if by is None else [by, 'event_type']
+    groups = event_cars.assign(scar=scar, scar_var=scar_var).groupby(
+        keys, observed=True)
+    scar = groups['scar']
+    n_std = scar.count()
+    patell_z = scar.sum() / np.sqrt(groups['scar_var'].sum())
+    bmp_t = scar.mean() / scar.sem()
+    return pd.DataFrame({'patell_z': patell_z, 'bmp_t': bmp_t, 'n_std': n_std})
+
+
+# --------------------------------------------------------
+#   Resampling tests
+# --------------------------------------------------------
+def calc_resampling_tests(event_cars, by=None, n_resamples=10_000, alpha=0.05,
+                          seed=0, chunk=None, max_workers=None, col='car'):
+    """ Compute bootstrap confidence intervals and sign/permutation p-values
+    for the mean CAR of each event type in `event_cars`.
+
+    Parameters
+    ----------
+    event_cars : dataframe
+        Dataframe with event types and CARs for each event in the sample.
+
+    by : str, optional
+        See `calc_tstats`
+
+    n_resamples : int, optional
+        Number of bootstrap resamples (and of sign-flip permutations).
+        Defaults to 10,000.
+
+    alpha : float, optional
+        The confidence intervals have coverage 1 - `alpha`. Defaults to 0.05.
+
+    seed : int, optional
+        Seed of the random number generator. Defaults to 0.
+
+    chunk : int, optional
+        Number of resamples drawn at once. If None (the default), chosen so
+        that each chunk holds about 10 million draws.
+
+    max_workers : int, optional
+        If given, chunks are spread over this many worker processes.
+        If None (the default), all chunks are processed in this process.
+
+    col : str, optional
+        See `calc_tstats`. Defaults to 'car'.
+
+    Returns
+    -------
+    dataframe
+        A data frame with one row per event type and the columns:
+            car_bar : mean CAR (named after `col`)
+            ci_lo, ci_hi : bootstrap (percentile) confidence interval
+            p_sign : two-sided p-value of the sign test (binomial test of
+                the share of positive CARs against 1/2)
+            p_perm : two-sided p-value of the sign-flip permutation test of
+                mean CAR = 0
+            n_obs : number of events
+
+    Notes
+    -----
+    Resamples are drawn as index (bootstrap) or sign (permutation) matrices
+    with one row per resample, so each chunk is a single array operation.
+    Each chunk uses its own seed, derived from `seed`, so the results do not
+    depend on `max_workers`. The chunks of all groups are submitted to a
+    single pool of worker processes.
+    """
+    keys = 'event_type' if by is None else [by, 'event_type']
+    groups = event_cars.groupby(keys, observed=True)[col]
+    samples = {name: ser.dropna().to_numpy(dtype=float)
+               for name, ser in groups}
+
+    # Resample the chunks of all groups at once
+    args = {name: _chunk_args(cars, n_resamples, seed, chunk)
+            for name, cars in samples.items()}
+    flat = [a for name in args for a in args[name]]
+    if max_workers is None or len(flat) == 0:
+        out = [_resample_chunk(*a) for a in flat]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            out = list(executor.map(_resample_chunk, *zip(*flat)))
+
+    rows = {}
+    start = 0
+    for name, cars in samples.items():
+        stop = start + len(args[name])
+        rows[name] = _resampling_tests(cars, out[start:stop], alpha)
+        start = stop
+    res = pd.DataFrame.from_dict(rows, orient='index')
+    res.index.names = keys if by is not None else [keys]
+    return res.rename(columns={'car_bar': f'{col}_bar'})
+
+
+def _chunk_args(cars, n_resamples, seed, chunk):
+    """ Splits the resamples of `cars` into chunks, each with its own seed.
+    Returns the arguments of `_resample_chunk` for each chunk (none if `cars`
+    is empty).
+    """
+    n = len(cars)
+    if n == 0:
+        return []
+    if chunk is None:
+        chunk = max(1, 10_000_000 // n)
+    sizes = [min(chunk, n_resamples - i) for i in range(0, n_resamples, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    return [(cars, size, s) for size, s in zip(sizes, seeds)]
+
+
+def _resampling_tests(cars, out, alpha):
+    """ Implements `calc_resampling_tests` for a single array of CARs, where
+    `out` holds the outputs of `_resample_chunk` for its chunks
+    """
+    n = len(cars)
+    res = {
+        'car_bar': np.nan, 'ci_lo': np.nan, 'ci_hi': np.nan,
+        'p_sign': np.nan, 'p_perm': np.nan, 'n_obs': n,
+    }
+    if n == 0:
+        return res
+    car_bar = cars.mean()
+    res['car_bar'] = car_bar
+
+    boot = np.concatenate([o[0] for o in out])
+    perm = np.concatenate([o[1] for o in out])
+
+    # Bootstrap percentile interval
+    res['ci_lo'], res['ci_hi'] = np.quantile(boot, [alpha / 2, 1 - alpha / 2])
+    # Sign-flip permutation test (the observed sample counts as a resample)
+    extreme = np.sum(np.abs(perm) >= np.abs(car_bar))
+    res['p_perm'] = (extreme + 1) / (len(perm) + 1)
+    # Sign test (zero CARs are dropped)
+    pos = int(np.sum(cars > 0))
+    nonzero = int(np.sum(cars != 0))
+    res['p_sign'] = _binom_test(pos, nonzero)
     return res
+
+
+def _resample_chunk(cars, size, seed_seq):
+    """ Returns the means of `size` bootstrap resamples and of `size` sign
+    flipped samples of `cars`
+    """
+    rng = np.random.default_rng(seed_seq)
+    n = len(cars)
+    # Bootstrap: one row of indices per resample
+    idx = rng.integers(0, n, size=(size, n))
+    boot = cars[idx].mean(axis=1)
+    # Permutation: one row of random signs per resample
+    signs = rng.integers(0, 2, size=(size, n), dtype=np.int8) * 2 - 1
+    perm = (signs * cars).mean(axis=1)
+    return boot, perm
+
+
+def _binom_test(k, n):
+    """ Two-sided p-value of the binomial test of k successes in n trials
+    with probability 1/2
+    """
+    if n == 0:
+        return np.nan
+    # Probabilities of 0..n successes (in logs to avoid overflow), using
+    # C(n, x) = C(n, x - 1) * (n - x + 1) / x
+    x = np.arange(1, n + 1)
+    log_comb = np.concatenate([[0.0], np.cumsum(np.log(n - x + 1) - np.log(x))])
+    p = np.exp(log_comb - n * np.log(2))
+    tail = min(p[:k + 1].sum(), p[k:].sum())
+    return min(1.0, 2 * tail)